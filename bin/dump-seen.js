@@ -0,0 +1,7 @@
+// Prints the keys the generator's local seen store is built from:
+// seen game ids, then the fen:uci keys of existing puzzles.
+// mongosh puzzler --quiet bin/dump-seen.js > seen.txt
+
+db.seen.find({}, { _id: 1 }).forEach(s => print(s._id));
+
+db.puzzle2.find({}, { fen: 1, moves: 1 }).forEach(p => print(p.fen + ':' + p.moves[0]));
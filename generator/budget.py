@@ -0,0 +1,134 @@
+import threading
+import time
+from chess import Board
+from chess.engine import InfoDict, Limit, PlayResult
+from dataclasses import dataclass
+from engines import Analysis, Engine
+from typing import Any, Iterator, List, Optional, Union
+
+class BudgetExceeded(Exception):
+    pass
+
+class Cancelled(Exception):
+    pass
+
+@dataclass(frozen=True)
+class GameBudget:
+    seconds: float
+    nodes: int
+
+class Budget:
+    """
+    Wall time and engine nodes a game may still use, unlimited without `limits`,
+    checked before each search so that a slow game is given up between two searches.
+    """
+
+    def __init__(self, limits: Optional[GameBudget]) -> None:
+        self.limits = limits
+        self.start = time.monotonic()
+        self.nodes = 0
+        self.lock = threading.Lock()
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.start
+
+    def spend(self, infos: Any) -> None:
+        info = infos[0] if isinstance(infos, list) and infos else infos
+        if isinstance(info, dict):
+            with self.lock:
+                self.nodes += info.get("nodes", 0)
+
+    def check(self) -> None:
+        if self.limits and (self.elapsed() > self.limits.seconds or self.nodes > self.limits.nodes):
+            raise BudgetExceeded(f"{self.elapsed():.0f}s and {self.nodes} nodes spent")
+
+    def probe(self) -> "ProbeBudget":
+        return ProbeBudget(self)
+
+class ProbeBudget:
+    """
+    The share of a budget used by one of the positions probed in parallel, which can be cancelled alone.
+    Cancelling it cancels the probes made from it as well.
+    """
+
+    def __init__(self, parent: Union[Budget, "ProbeBudget"]) -> None:
+        self.parent = parent
+        self.cancelled = False
+
+    def spend(self, infos: Any) -> None:
+        self.parent.spend(infos)
+
+    def check(self) -> None:
+        if self.cancelled:
+            raise Cancelled()
+        self.parent.check()
+
+    def cancel(self) -> None:
+        self.cancelled = True
+
+    def probe(self) -> "ProbeBudget":
+        return ProbeBudget(self)
+
+class BudgetedEngine:
+    """
+    Charges the searches of the wrapped engine to `budget`, when set,
+    raising `BudgetExceeded` instead of starting a search once it is spent.
+    The budget is set for each thread searching.
+    """
+
+    def __init__(self, engine: Engine) -> None:
+        self.engine = engine
+        self.local = threading.local()
+
+    @property
+    def budget(self) -> Optional[Union[Budget, ProbeBudget]]:
+        return getattr(self.local, "budget", None)
+
+    @budget.setter
+    def budget(self, budget: Optional[Union[Budget, ProbeBudget]]) -> None:
+        self.local.budget = budget
+
+    def analyse(self, board: Board, limit: Limit, **kwargs: Any) -> Any:
+        if self.budget:
+            self.budget.check()
+        # by keyword, some engines name their arguments in a different order
+        infos = self.engine.analyse(board, limit = limit, **kwargs)
+        if self.budget:
+            self.budget.spend(infos)
+        return infos
+
+    def analysis(self, board: Board, limit: Limit, **kwargs: Any) -> Analysis:
+        if self.budget:
+            self.budget.check()
+        analysis = self.engine.analysis(board, limit, **kwargs)
+        return MeteredAnalysis(analysis, self.budget) if self.budget else analysis
+
+    def play(self, board: Board, limit: Limit, **kwargs: Any) -> PlayResult:
+        if self.budget:
+            self.budget.check()
+        return self.engine.play(board, limit, **kwargs)
+
+class MeteredAnalysis:
+    """Passes an analysis through, charging the nodes searched when it ends"""
+
+    def __init__(self, analysis: Analysis, budget: Union[Budget, ProbeBudget]) -> None:
+        self.analysis = analysis
+        self.budget = budget
+
+    def __enter__(self) -> "MeteredAnalysis":
+        self.analysis.__enter__()
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.analysis.__exit__(*args)
+        self.budget.spend(self.multipv)
+
+    def __iter__(self) -> Iterator[InfoDict]:
+        return iter(self.analysis)
+
+    def stop(self) -> None:
+        self.analysis.stop()
+
+    @property
+    def multipv(self) -> List[InfoDict]:
+        return self.analysis.multipv
@@ -0,0 +1,251 @@
+import json
+import sqlite3
+import threading
+import time
+import chess
+from collections import OrderedDict
+import chess.polyglot
+from chess import Board, Move
+from chess.engine import Cp, InfoDict, Limit, Mate, PlayResult, PovScore, Score
+from engines import Analysis, Engine
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tablebase (
+    epd TEXT PRIMARY KEY,
+    response TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS analysis (
+    zobrist INTEGER NOT NULL,
+    multipv INTEGER NOT NULL,
+    lim TEXT NOT NULL,
+    infos TEXT NOT NULL,
+    used REAL NOT NULL,
+    PRIMARY KEY (zobrist, multipv, lim)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS analysis_used ON analysis (used);
+"""
+
+class SqliteCache:
+    """
+    A single SQLite file that can be shared by all the generator processes of a host,
+    with a connection per thread.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.local = threading.local()
+        with self._db() as db:
+            db.executescript(SCHEMA)
+
+    def _db(self) -> sqlite3.Connection:
+        if not hasattr(self.local, "db"):
+            db = sqlite3.connect(self.path, timeout = 30)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self.local.db = db
+        return self.local.db
+
+class AnalysisCache(SqliteCache):
+    """
+    Engine analysis results keyed by Zobrist hash and halfmove clock, multipv and search limit.
+    Keeps at most about `max_entries` results, evicting the least recently used ones.
+    Hits are only read: their use times are written by batches of `touch_batch`.
+    """
+
+    def __init__(self, path: str, max_entries: int, touch_batch: int = 1000) -> None:
+        super().__init__(path)
+        self.max_entries = max_entries
+        self.touch_batch = touch_batch
+        self.puts = 0
+        self.touched: Dict[Tuple[int, int, str], float] = {}
+        self.lock = threading.Lock()
+
+    def get(self, board: Board, multipv: int, limit: str) -> Optional[List[InfoDict]]:
+        key = (zobrist(board), multipv, limit)
+        row = self._db().execute("SELECT infos FROM analysis WHERE zobrist = ? AND multipv = ? AND lim = ?", key).fetchone()
+        if row is None:
+            return None
+        with self.lock:
+            self.touched[key] = time.time()
+            full = len(self.touched) >= self.touch_batch
+        if full:
+            self.flush()
+        return [decode_info(board, info) for info in json.loads(row[0])]
+
+    def put(self, board: Board, multipv: int, limit: str, infos: List[InfoDict]) -> None:
+        encoded = json.dumps([encode_info(info) for info in infos], separators = (",", ":"))
+        with self._db() as db:
+            db.execute("INSERT OR REPLACE INTO analysis VALUES (?, ?, ?, ?, ?)", (zobrist(board), multipv, limit, encoded, time.time()))
+        self.puts += 1
+        if self.puts % 1000 == 0:
+            self.evict()
+
+    def flush(self) -> None:
+        with self.lock:
+            touched, self.touched = self.touched, {}
+        if touched:
+            with self._db() as db:
+                db.executemany("UPDATE analysis SET used = ? WHERE zobrist = ? AND multipv = ? AND lim = ?", ((used,) + key for key, used in touched.items()))
+
+    def evict(self) -> None:
+        self.flush()
+        with self._db() as db:
+            count = db.execute("SELECT COUNT(*) FROM analysis").fetchone()[0]
+            if count > self.max_entries:
+                db.execute("DELETE FROM analysis WHERE used < (SELECT used FROM analysis ORDER BY used LIMIT 1 OFFSET ?)", (count - self.max_entries,))
+
+class TablebaseCache(SqliteCache):
+    """
+    Tablebase API responses keyed by EPD, i.e. FEN without move counters, followed by the halfmove clock,
+    with the most recently used ones also kept in memory.
+    """
+
+    def __init__(self, path: str, memory_entries: int = 10_000) -> None:
+        super().__init__(path)
+        self.memory: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.memory_entries = memory_entries
+        self.lock = threading.Lock()
+
+    def get(self, epd: str) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            if epd in self.memory:
+                self.memory.move_to_end(epd)
+                return self.memory[epd]
+        with self._db() as db:
+            row = db.execute("SELECT response FROM tablebase WHERE epd = ?", (epd,)).fetchone()
+        if row is None:
+            return None
+        response = json.loads(row[0])
+        self._remember(epd, response)
+        return response
+
+    def put(self, epd: str, response: Dict[str, Any]) -> None:
+        with self._db() as db:
+            db.execute("INSERT OR REPLACE INTO tablebase VALUES (?, ?)", (epd, json.dumps(response, separators = (",", ":"))))
+        self._remember(epd, response)
+
+    def _remember(self, epd: str, response: Dict[str, Any]) -> None:
+        with self.lock:
+            self.memory[epd] = response
+            self.memory.move_to_end(epd)
+            while len(self.memory) > self.memory_entries:
+                self.memory.popitem(last = False)
+
+class CachingEngine:
+    """
+    Serves `analyse` and `analysis` calls from an `AnalysisCache`, searching with the wrapped engine on misses.
+    Only analyses run to completion are cached, and not those of positions already seen in the game,
+    whose search depends on the moves that led to them.
+    """
+
+    def __init__(self, engine: Engine, cache: AnalysisCache) -> None:
+        self.engine = engine
+        self.cache = cache
+
+    def analyse(self, board: Board, limit: Limit, *, multipv: Optional[int] = None, **kwargs: Any) -> Any:
+        if kwargs or not cacheable(board):
+            return self.engine.analyse(board, limit, multipv = multipv, **kwargs)
+        key = str(limit)
+        infos = self.cache.get(board, multipv or 0, key)
+        if infos is None:
+            result = self.engine.analyse(board, limit, multipv = multipv)
+            infos = result if isinstance(result, list) else [result]
+            self.cache.put(board, multipv or 0, key, infos)
+        return infos if multipv else infos[0]
+
+    def analysis(self, board: Board, limit: Limit, *, multipv: Optional[int] = None, **kwargs: Any) -> Analysis:
+        if kwargs or not cacheable(board):
+            return self.engine.analysis(board, limit, multipv = multipv, **kwargs)
+        key = str(limit)
+        infos = self.cache.get(board, multipv or 0, key)
+        if infos is not None:
+            return ReplayedAnalysis(infos)
+        board = board.copy()
+        return RecordingAnalysis(self.engine.analysis(board, limit, multipv = multipv), lambda infos: self.cache.put(board, multipv or 0, key, infos))
+
+    def play(self, board: Board, limit: Limit, **kwargs: Any) -> PlayResult:
+        return self.engine.play(board, limit, **kwargs)
+
+class ReplayedAnalysis:
+    """A cached analysis, yielding its final info for each line"""
+
+    def __init__(self, infos: List[InfoDict]) -> None:
+        self.multipv = infos
+
+    def __enter__(self) -> "ReplayedAnalysis":
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        pass
+
+    def __iter__(self) -> Iterator[InfoDict]:
+        for i, info in enumerate(self.multipv):
+            yield dict(info, multipv = i + 1) # type: ignore
+
+    def stop(self) -> None:
+        pass
+
+class RecordingAnalysis:
+    """Passes an analysis through, calling `on_complete` with its final lines if it was not stopped"""
+
+    def __init__(self, analysis: Analysis, on_complete: Callable[[List[InfoDict]], None]) -> None:
+        self.analysis = analysis
+        self.on_complete = on_complete
+        self.complete = False
+        self.stopped = False
+
+    def __enter__(self) -> "RecordingAnalysis":
+        self.analysis.__enter__()
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.analysis.__exit__(*args)
+        if self.complete and not self.stopped:
+            self.on_complete(self.multipv)
+
+    def __iter__(self) -> Iterator[InfoDict]:
+        yield from self.analysis
+        self.complete = True
+
+    def stop(self) -> None:
+        self.stopped = True
+        self.analysis.stop()
+
+    @property
+    def multipv(self) -> List[InfoDict]:
+        return self.analysis.multipv
+
+# mixes the halfmove clock into the key, as the 50 moves rule changes the search
+HALFMOVE_KEY = 0x9E3779B97F4A7C15
+
+def zobrist(board: Board) -> int:
+    key = (chess.polyglot.zobrist_hash(board) ^ board.halfmove_clock * HALFMOVE_KEY) % (1 << 64)
+    # sqlite integers are signed
+    return key - (1 << 63)
+
+def cacheable(board: Board) -> bool:
+    return not board.is_repetition(2)
+
+def encode_info(info: InfoDict) -> Dict[str, Any]:
+    score = info["score"].relative
+    return {
+        "s": score.mate() if score.is_mate() else score.score(),
+        "m": score.is_mate(),
+        "pv": " ".join(move.uci() for move in info.get("pv", [])),
+        "d": info.get("depth"),
+        "n": info.get("nodes"),
+        "nps": info.get("nps"),
+    }
+
+def decode_info(board: Board, encoded: Dict[str, Any]) -> InfoDict:
+    relative: Score = Mate(encoded["s"]) if encoded["m"] else Cp(encoded["s"])
+    info: InfoDict = {
+        "score": PovScore(relative, board.turn),
+        "pv": [Move.from_uci(uci) for uci in encoded["pv"].split()],
+    }
+    # nothing was searched to replay it: no nodes are charged to the game budget,
+    # and no speed is counted in the engine stats
+    if encoded["d"] is not None:
+        info["depth"] = encoded["d"]
+    return info
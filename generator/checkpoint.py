@@ -0,0 +1,29 @@
+import json
+import os
+from dataclasses import asdict, dataclass
+from typing import Optional
+
+@dataclass
+class Checkpoint:
+    version: int
+    # games read from the source before the resume point
+    games: int
+    # offset of the resume point in the decompressed PGN
+    offset: int
+    # compressed offset of the zstd frame holding the resume point
+    compressed: int
+    # decompressed offset at which that frame starts
+    frame: int
+
+def load(path: str) -> Optional[Checkpoint]:
+    try:
+        with open(path) as f:
+            return Checkpoint(**json.load(f))
+    except FileNotFoundError:
+        return None
+
+def save(path: str, checkpoint: Checkpoint) -> None:
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(asdict(checkpoint), f)
+    os.replace(tmp, path)
@@ -0,0 +1,150 @@
+import asyncio
+import threading
+import chess
+import chess.engine
+from chess import Board
+from chess.engine import AnalysisResult, InfoDict, Limit, PlayResult, UciProtocol
+from typing import Any, Awaitable, Iterator, List, Optional, Protocol, TypeVar
+
+T = TypeVar("T")
+
+class Analysis(Protocol):
+    """
+    A search in progress, yielding engine info as it comes, like `SimpleAnalysisResult`.
+    Used as a context manager, which stops the search on exit.
+    """
+
+    def __enter__(self) -> "Analysis": ...
+
+    def __exit__(self, *args: Any) -> None: ...
+
+    def __iter__(self) -> Iterator[InfoDict]: ...
+
+    def stop(self) -> None: ...
+
+    @property
+    def multipv(self) -> List[InfoDict]: ...
+
+class Engine(Protocol):
+    """What the generator runs its searches against, `SimpleEngine` or one of the wrappers below."""
+
+    def analyse(self, board: Board, limit: Limit, *, multipv: Optional[int] = None, **kwargs: Any) -> Any: ...
+
+    def analysis(self, board: Board, limit: Limit, *, multipv: Optional[int] = None, **kwargs: Any) -> Analysis: ...
+
+    def play(self, board: Board, limit: Limit, **kwargs: Any) -> PlayResult: ...
+
+class EnginePool:
+    """
+    Several UCI engines driven by a single asyncio loop running in a background thread.
+    Each search runs on whichever engine is idle, so searches requested concurrently,
+    e.g. by several games analysed at once, proceed in parallel while other
+    callers wait on the network.
+    """
+
+    def __init__(self, executable: str, engines: int, threads: int) -> None:
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.engines: List[UciProtocol] = []
+        self.run(self._start(executable, engines, threads))
+
+    async def _start(self, executable: str, engines: int, threads: int) -> None:
+        # created from within the loop, python 3.8 queues bind to the running loop
+        self.idle: "asyncio.Queue[UciProtocol]" = asyncio.Queue()
+        for _ in range(engines):
+            _, engine = await chess.engine.popen_uci(executable)
+            await engine.configure({'Threads': threads})
+            self.engines.append(engine)
+            self.idle.put_nowait(engine)
+
+    async def analyse(self, board: Board, limit: Limit, **kwargs: Any) -> Any:
+        engine = await self.idle.get()
+        try:
+            return await engine.analyse(board, limit, **kwargs)
+        finally:
+            self.idle.put_nowait(engine)
+
+    async def play(self, board: Board, limit: Limit, **kwargs: Any) -> PlayResult:
+        engine = await self.idle.get()
+        try:
+            return await engine.play(board, limit, **kwargs)
+        finally:
+            self.idle.put_nowait(engine)
+
+    def run(self, coroutine: Awaitable[T]) -> T:
+        """Runs `coroutine` on the pool loop, blocking the calling thread until it completes."""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result() # type: ignore
+
+    async def _quit(self) -> None:
+        await asyncio.gather(*[engine.quit() for engine in self.engines], return_exceptions=True)
+
+    def close(self) -> None:
+        self.run(self._quit())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+class PooledEngine:
+    """
+    Blocking view of an `EnginePool`, offering the part of the `SimpleEngine`
+    API the generator uses, so that each thread analysing a game can share the pool.
+    """
+
+    def __init__(self, pool: EnginePool) -> None:
+        self.pool = pool
+
+    def analyse(self, board: Board, limit: Limit, **kwargs: Any) -> Any:
+        return self.pool.run(self.pool.analyse(board.copy(), limit, **kwargs))
+
+    def analysis(self, board: Board, limit: Limit, **kwargs: Any) -> "PooledAnalysis":
+        return PooledAnalysis(self.pool, board.copy(), limit, **kwargs)
+
+    def play(self, board: Board, limit: Limit, **kwargs: Any) -> PlayResult:
+        return self.pool.run(self.pool.play(board.copy(), limit, **kwargs))
+
+class PooledAnalysis:
+    """
+    Blocking view of an analysis running on an engine of the pool,
+    which is held from entering the context until the search is over.
+    """
+
+    def __init__(self, pool: EnginePool, board: Board, limit: Limit, **kwargs: Any) -> None:
+        self.pool = pool
+        self.board = board
+        self.limit = limit
+        self.kwargs = kwargs
+
+    def __enter__(self) -> "PooledAnalysis":
+        self.engine = self.pool.run(self.pool.idle.get())
+        try:
+            self.result: AnalysisResult = self.pool.run(self.engine.analysis(self.board, self.limit, **self.kwargs))
+        except BaseException:
+            self._release()
+            raise
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        try:
+            self.stop()
+            self.pool.run(self.result.wait())
+        finally:
+            self._release()
+
+    def __iter__(self) -> "PooledAnalysis":
+        return self
+
+    def __next__(self) -> InfoDict:
+        try:
+            return self.pool.run(self.result.get())
+        except chess.engine.AnalysisComplete:
+            raise StopIteration
+
+    def stop(self) -> None:
+        self.pool.loop.call_soon_threadsafe(self.result.stop)
+
+    @property
+    def multipv(self) -> List[InfoDict]:
+        return self.result.multipv
+
+    def _release(self) -> None:
+        self.pool.loop.call_soon_threadsafe(self.pool.idle.put_nowait, self.engine)
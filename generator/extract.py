@@ -0,0 +1,83 @@
+import argparse
+import os
+import zlib
+import zstandard
+from collections import Counter
+from model import RawGame
+from reader import PgnSource, SHARD_MAGIC, shard_line
+from typing import BinaryIO, Dict, Iterable, Tuple
+
+class ShardWriter:
+    """
+    Writes games to zstd compressed shards in `dir`, one by tier and by id hash,
+    named PREFIX-tierT-SS.evals.zst. Shards are written to temporary files,
+    moved in place when closed, so that a shard present is always complete.
+    Leaving the writer on an exception deletes them instead.
+    """
+
+    def __init__(self, dir: str, prefix: str, shards: int = 1, level: int = 10) -> None:
+        self.dir = dir
+        self.prefix = prefix
+        self.shards = shards
+        self.level = level
+        self.files: Dict[Tuple[int, int], BinaryIO] = {}
+        self.counts: Counter = Counter()
+        os.makedirs(dir, exist_ok = True)
+
+    def path(self, tier: int, shard: int) -> str:
+        return os.path.join(self.dir, f"{self.prefix}-tier{tier}-{shard:02}.evals.zst")
+
+    def write(self, raw: RawGame) -> None:
+        key = (raw.tier, zlib.crc32(raw.id.encode()) % self.shards)
+        if key not in self.files:
+            # a compressor can only write one stream at a time
+            self.files[key] = zstandard.ZstdCompressor(level = self.level).stream_writer(open(f"{self.path(*key)}.tmp", "wb"))
+            self.files[key].write(SHARD_MAGIC)
+        self.files[key].write(shard_line(raw))
+        self.counts[raw.tier] += 1
+
+    def close(self) -> None:
+        for key, file in self.files.items():
+            file.close()
+            os.replace(f"{self.path(*key)}.tmp", self.path(*key))
+        self.files = {}
+
+    def abort(self) -> None:
+        for key, file in self.files.items():
+            file.close()
+            os.remove(f"{self.path(*key)}.tmp")
+        self.files = {}
+
+    def __enter__(self) -> "ShardWriter":
+        return self
+
+    def __exit__(self, exc_type, *args) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+def extract(games: Iterable[RawGame], writer: ShardWriter) -> Counter:
+    with writer:
+        for raw in games:
+            writer.write(raw)
+    return writer.counts
+
+def prefix_of(file: str) -> str:
+    name = os.path.basename(file)
+    for suffix in [".zst", ".pgn"]:
+        name = name[:-len(suffix)] if name.endswith(suffix) else name
+    return name
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog='extract.py',
+        description='extracts the standard games with evals worth analysing from a PGN dump, to shards that generator.py reads instead of the dump')
+    parser.add_argument("file", help="PGN dump, plain or zstd compressed", metavar="FILE.pgn.zst")
+    parser.add_argument("--output", "-o", help="directory where to write the shards", default="shards")
+    parser.add_argument("--shards", help="count of shards by tier, games being spread by id", default="1")
+    args = parser.parse_args()
+    with PgnSource(args.file) as source:
+        counts = extract(source.games(), ShardWriter(args.output, prefix_of(args.file), int(args.shards)))
+    for tier in sorted(counts):
+        print(f"tier {tier}: {counts[tier]} games")
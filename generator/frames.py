@@ -0,0 +1,154 @@
+import argparse
+import bisect
+import multiprocessing
+import multiprocessing.pool
+import os
+from array import array
+from collections import deque
+from dataclasses import dataclass
+from itertools import islice
+import zstandard
+from checkpoint import Checkpoint
+from model import RawGame
+from reader import PgnSource, read_games
+from typing import Deque, Iterable, Iterator, List, Optional
+
+MAGIC = b"LPFRAME1"
+INDEX_SUFFIX = ".frames"
+# decompressed bytes of PGN by frame
+FRAME_SIZE = 1 << 22
+
+@dataclass(frozen=True)
+class Frame:
+    # offset of the frame in the compressed file
+    compressed: int
+    # offset of its first game in the decompressed PGN
+    offset: int
+    # games before it
+    games: int
+
+class FrameWriter:
+    """
+    Writes PGN lines to a zstd file in independent frames of about `frame_size`
+    decompressed bytes, each starting with a game, so that any frame can be
+    decompressed and parsed alone. `frames` ends with the end of the file.
+    """
+
+    def __init__(self, path: str, frame_size: int = FRAME_SIZE, level: int = 10) -> None:
+        self.file = open(path, "wb")
+        self.cctx = zstandard.ZstdCompressor(level = level)
+        self.frame_size = frame_size
+        self.buffer: List[bytes] = []
+        self.size = 0
+        self.games = 0
+        self.frames = [Frame(0, 0, 0)]
+
+    def write(self, line: bytes) -> None:
+        if line.startswith(b"[Event "):
+            if self.size >= self.frame_size:
+                self.flush()
+            self.games += 1
+        self.buffer.append(line)
+        self.size += len(line)
+
+    def flush(self) -> None:
+        if self.buffer:
+            self.file.write(self.cctx.compress(b"".join(self.buffer)))
+            self.frames.append(Frame(self.file.tell(), self.frames[-1].offset + self.size, self.games))
+            self.buffer = []
+            self.size = 0
+
+    def close(self) -> None:
+        self.flush()
+        self.file.close()
+
+def reframe(lines: Iterable[bytes], path: str, frame_size: int = FRAME_SIZE) -> List[Frame]:
+    """Writes `lines` to a zstd file at `path` with frames aligned on games, and its frame index next to it"""
+    writer = FrameWriter(f"{path}.tmp", frame_size)
+    for line in lines:
+        writer.write(line)
+    writer.close()
+    save_index(f"{path}{INDEX_SUFFIX}", writer.frames)
+    os.replace(f"{path}.tmp", path)
+    return writer.frames
+
+def save_index(path: str, frames: List[Frame]) -> None:
+    with open(path, "wb") as f:
+        f.write(MAGIC)
+        f.write(array("Q", (value for frame in frames for value in (frame.compressed, frame.offset, frame.games))).tobytes())
+
+def load_index(path: str) -> Optional[List[Frame]]:
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError(f"{path} is not a frame index")
+    values = array("Q", data[len(MAGIC):])
+    return [Frame(*values[i:i + 3]) for i in range(0, len(values), 3)]
+
+def read_frame(path: str, frame: Frame, end: int) -> List[RawGame]:
+    """The games of the frame starting at `frame`, up to the `end` compressed offset, decompressed alone"""
+    with open(path, "rb") as f:
+        f.seek(frame.compressed)
+        data = zstandard.ZstdDecompressor().decompress(f.read(end - frame.compressed))
+    return list(read_games(data.splitlines(keepends = True), frame.offset, frame.games))
+
+class FramedSource:
+    """
+    A zstd PGN file written by `reframe`, whose frames are decompressed and
+    parsed by `readers` processes at once. Games are still yielded in file order,
+    with at most two frames by reader decompressed ahead.
+    """
+
+    def __init__(self, file: str, frames: List[Frame], readers: int, checkpoint: Optional[Checkpoint] = None) -> None:
+        self.file = file
+        self.frames = frames
+        self.offsets = [frame.offset for frame in frames]
+        self.readers = readers
+        self.resume = checkpoint.offset if checkpoint else 0
+        self.pool: Optional[multiprocessing.pool.Pool] = None
+
+    def games(self) -> Iterator[RawGame]:
+        # started on first read, once the analysis workers are forked
+        self.pool = multiprocessing.Pool(self.readers)
+        first = self.frame_of(self.resume)
+        tasks = ((self.file, frame, next.compressed) for frame, next in zip(self.frames[first:-1], self.frames[first + 1:]))
+        pending: Deque[multiprocessing.pool.AsyncResult] = deque(self.pool.apply_async(read_frame, task) for task in islice(tasks, self.readers * 2))
+        while pending:
+            games = pending.popleft().get()
+            pending.extend(self.pool.apply_async(read_frame, task) for task in islice(tasks, 1))
+            for raw in games:
+                if raw.offset >= self.resume:
+                    yield raw
+
+    def frame_of(self, offset: int) -> int:
+        return max(0, bisect.bisect_right(self.offsets, offset) - 1)
+
+    def checkpoint_at(self, raw: RawGame, version: int, after: bool = False) -> Checkpoint:
+        offset = raw.end if after else raw.offset
+        frame = self.frames[self.frame_of(offset)]
+        return Checkpoint(version = version, games = raw.index - (not after), offset = offset, compressed = frame.compressed, frame = frame.offset)
+
+    def __enter__(self) -> "FramedSource":
+        return self
+
+    def __exit__(self, *args) -> None:
+        if self.pool:
+            self.pool.terminate()
+
+def lines_of(file: str) -> Iterator[bytes]:
+    with PgnSource(file) as source:
+        yield from source.stream
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog='frames.py',
+        description='rewrites a PGN dump to zstd frames starting with a game, with an index, so that generator.py --readers decompresses it in parallel')
+    parser.add_argument("file", help="PGN dump, plain or zstd compressed", metavar="FILE.pgn.zst")
+    parser.add_argument("--output", "-o", help="zstd PGN file to write, its index being written to OUTPUT.frames", required=True, metavar="OUTPUT.pgn.zst")
+    parser.add_argument("--frame-size", help="decompressed bytes by frame", default=str(FRAME_SIZE))
+    args = parser.parse_args()
+    frames = reframe(lines_of(args.file), args.output, int(args.frame_size))
+    print(f"{frames[-1].games} games written to {args.output} in {len(frames) - 1} frames")
@@ -0,0 +1,151 @@
+import argparse
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import chess
+import numpy as np
+import movetext
+from checkpoint import Checkpoint
+from model import RawGame
+from reader import PgnSource, SITE_PREFIX
+from typing import Iterable, Iterator, Optional
+
+GAME_FILE_SUFFIX = ".games"
+# game headers converted and written at once by `build`
+TABLE_BATCH = 10_000
+MAGIC = b"LPGAMES1"
+# magic, count of games, offset of the evals, offset of the game table
+HEADER = struct.Struct("=8sQQQ")
+# moves and evals are indices in the move and eval arrays of the first of the game's
+GAME = np.dtype([
+    ("id", "S8"),
+    ("moves", "<u8"),
+    ("evals", "<u8"),
+    ("nb_moves", "<u2"),
+    ("nb_evals", "<u2"),
+    ("white_elo", "<u2"),
+    ("black_elo", "<u2"),
+    ("seconds", "<u2"),
+    ("increment", "<u2"),
+    ("tier", "u1"),
+    ("has_master", "u1"),
+], align = True)
+
+class GameFile:
+    """
+    Games written by `build`: the 16 bits moves of all games, then their evals,
+    then a table of game headers pointing into both. The file is memory mapped
+    read only, and moves and evals are returned as views of it, so that any game
+    is read by index without parsing, and all the processes of a host share the same pages.
+    """
+
+    def __init__(self, path: str) -> None:
+        with open(path, "rb") as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        magic, count, evals_at, games_at = HEADER.unpack_from(self.mmap)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a game file")
+        self.codes = np.frombuffer(self.mmap, "<u2", (evals_at - HEADER.size) // 2, HEADER.size)
+        self.evals = np.frombuffer(self.mmap, "<i2", (games_at - evals_at) // 2, evals_at)
+        self.games = np.frombuffer(self.mmap, GAME, count, games_at)
+
+    def __len__(self) -> int:
+        return len(self.games)
+
+    def raw(self, i: int) -> RawGame:
+        """The game at 0-based index `i`, without movetext: its moves are read with `moves`"""
+        game = self.games[i]
+        return RawGame(
+            i + 1, i, SITE_PREFIX + game["id"].decode(), int(game["tier"]), bool(game["has_master"]), b"",
+            int(game["white_elo"]), int(game["black_elo"]), (int(game["seconds"]), int(game["increment"])))
+
+    def moves(self, i: int) -> movetext.Moves:
+        game = self.games[i]
+        moves, evals = int(game["moves"]), int(game["evals"])
+        return movetext.Moves([], self.evals[evals:evals + game["nb_evals"]], codes = self.codes[moves:moves + game["nb_moves"]])
+
+class GameFileSource:
+    """A game file as a source of games for the generator, resumed from a checkpoint by game index"""
+
+    def __init__(self, file: str, checkpoint: Optional[Checkpoint] = None) -> None:
+        self.file = GameFile(file)
+        self.start = checkpoint.games if checkpoint else 0
+
+    def games(self) -> Iterator[RawGame]:
+        return (self.file.raw(i) for i in range(self.start, len(self.file)))
+
+    def checkpoint_at(self, raw: RawGame, version: int, after: bool = False) -> Checkpoint:
+        return Checkpoint(version = version, games = raw.index - (not after), offset = raw.offset, compressed = 0, frame = 0)
+
+    def __enter__(self) -> "GameFileSource":
+        return self
+
+    def __exit__(self, *args) -> None:
+        pass
+
+def encode_moves(moves: movetext.Moves) -> Optional[np.ndarray]:
+    board = chess.Board(moves.fen)
+    codes = np.empty(len(moves), dtype = "<u2")
+    try:
+        for ply in range(len(moves)):
+            move = moves.move(board, ply)
+            codes[ply] = movetext.encode_move(move)
+            board.push(move)
+    except ValueError:
+        return None
+    return codes
+
+def build(path: str, games: Iterable[RawGame]) -> int:
+    """Writes `games` to a game file at `path`, skipping games with illegal moves. Returns the count of games written."""
+    rows = []
+    count = nb_moves = nb_evals = 0
+    tmp = f"{path}.tmp"
+    dir = os.path.dirname(os.path.abspath(path))
+    with open(tmp, "wb") as f, tempfile.TemporaryFile(dir = dir) as evals, tempfile.TemporaryFile(dir = dir) as table:
+        f.write(HEADER.pack(MAGIC, 0, 0, 0))
+        for raw in games:
+            moves = movetext.parse(raw.movetext)
+            codes = encode_moves(moves)
+            if codes is None:
+                continue
+            seconds, increment = raw.time_control
+            rows.append((
+                raw.id.encode(), nb_moves, nb_evals, len(codes), len(moves.evals),
+                raw.white_elo, raw.black_elo, min(seconds, 65535), min(increment, 65535), raw.tier, raw.has_master))
+            if len(rows) >= TABLE_BATCH:
+                table.write(np.array(rows, dtype = GAME).tobytes())
+                rows = []
+            count += 1
+            f.write(codes.tobytes())
+            evals.write(moves.evals.astype("<i2").tobytes())
+            nb_moves += len(codes)
+            nb_evals += len(moves.evals)
+        evals_at = f.tell()
+        evals.seek(0)
+        shutil.copyfileobj(evals, f)
+        # aligns the table
+        f.write(bytes(-f.tell() % 8))
+        games_at = f.tell()
+        table.write(np.array(rows, dtype = GAME).tobytes())
+        table.seek(0)
+        shutil.copyfileobj(table, f)
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, count, evals_at, games_at))
+    os.replace(tmp, path)
+    return count
+
+def read_sources(files: Iterable[str]) -> Iterator[RawGame]:
+    for file in files:
+        with PgnSource(file) as source:
+            yield from source.games()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog='gamebin.py',
+        description='converts PGN dumps or shards written by extract.py to a game file, which generator.py reads without parsing')
+    parser.add_argument("files", nargs="+", help="PGN dumps or shards, plain or zstd compressed", metavar="FILE.evals.zst")
+    parser.add_argument("--output", "-o", help="game file to write", default=f"input{GAME_FILE_SUFFIX}")
+    args = parser.parse_args()
+    print(f"{build(args.output, read_sources(args.files))} games written to {args.output}")
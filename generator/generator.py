@@ -4,18 +4,35 @@ import chess
 import chess.pgn
 import chess.engine
 import copy
+import os
 import sys
+import threading
 import util
-import zstandard
-from model import Puzzle, NextMovePair, TbPair
+import movetext
+import numpy as np
+from model import Puzzle, EngineMove, NextMovePair, TbPair, RawGame
 from tb import TbChecker
-from io import StringIO
+from mate import MateProver
+from budget import Budget, BudgetExceeded, BudgetedEngine, Cancelled, GameBudget, ProbeBudget
 from chess import Move, Color
 from chess.engine import SimpleEngine, Mate, Cp, Score, PovScore
 from chess.pgn import Game, ChildNode
-from typing import List, Optional, Union, Set
-from util import get_next_move_pair, material_count, material_diff, is_up_in_material, maximum_castling_rights, win_chances, count_mates
-from server import Server
+from collections import Counter
+from dataclasses import dataclass, field, replace
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import partial
+from typing import Dict, Iterator, List, Optional, Tuple, Union, Set
+from util import get_next_move_pair, material_count, material_diff, is_up_in_material, maximum_castling_rights, win_chances, count_mates, mates_in_one, analyse_excluding
+from server import Server, position_key
+from seen import SeenStore
+from reader import PgnSource
+from gamebin import GameFile, GameFileSource, GAME_FILE_SUFFIX
+from frames import FramedSource, INDEX_SUFFIX, load_index
+from schedule import Scheduler
+from checkpoint import Checkpoint, load as load_checkpoint, save as save_checkpoint
+from orchestrator import Orchestrator
+from engines import Engine, EnginePool, PooledEngine
+from cache import AnalysisCache, CachingEngine, TablebaseCache
 
 version = 50
 
@@ -24,14 +41,129 @@ logging.basicConfig(format='%(asctime)s %(levelname)-4s %(message)s', datefmt='%
 
 pair_limit = chess.engine.Limit(depth = 50, time = 30, nodes = 25_000_000)
 mate_defense_limit = chess.engine.Limit(depth = 15, time = 10, nodes = 8_000_000)
+advantage_defense_limit = chess.engine.Limit(depth = 40, time = 15, nodes = 12_000_000)
+# bounds of searches stopping as soon as a mate is found: deeper than pair_limit, but no longer,
+# since the whole budget is spent when the game's eval announced a mate that isn't there
+mate_search_limit = chess.engine.Limit(depth = 80, time = 15, nodes = 12_000_000)
 
 mate_soon = Mate(15)
 
+@dataclass(frozen=True)
+class SearchProfile:
+    # 2 to know whether the best move is the only good one
+    multipv: int
+    limit: chess.engine.Limit
+
+@dataclass(frozen=True)
+class SearchConfig:
+    # the winner's moves must be unique, the defender's are only played
+    attack: SearchProfile = field(default_factory=lambda: SearchProfile(2, pair_limit))
+    defense: SearchProfile = field(default_factory=lambda: SearchProfile(1, advantage_defense_limit))
+    # cheap search run on the winner's plies before `pair_limit`, None to always search deep
+    shallow_limit: Optional[chess.engine.Limit] = field(default_factory=lambda: chess.engine.Limit(depth = 18, nodes = 1_500_000))
+    # shallow win chances gap between best and second move below which the attack is rejected right away
+    shallow_reject_gap: float = 0.3
+    # and above which the shallow search is trusted. Mate scores always go to the deep search
+    shallow_accept_gap: float = 1.5
+    # search checking that the defender plays the reply predicted by the previous search, None to always search in full
+    confirm_limit: Optional[chess.engine.Limit] = field(default_factory=lambda: chess.engine.Limit(depth = 18, nodes = 1_000_000))
+    # look for mates of known distance with `go mate`, bounded by `mate_search_limit`, then the other moves with a restricted search
+    mate_search: bool = True
+    # learn the score of the best move outside of a set, e.g. the mates in one, with a single line search restricted to the others
+    restricted_searches: bool = True
+    # mates up to that many moves are proven without the engine, 0 to always use the engine
+    prover_max_mate: int = 3
+    # positions the prover may visit for a single proof before giving up on it
+    prover_nodes: int = 100_000
+    # wall time and engine nodes a game may use, by tier. The highest tier's budget applies to higher tiers
+    budgets: Dict[int, GameBudget] = field(default_factory=lambda: {
+        1: GameBudget(seconds = 120, nodes = 500_000_000),
+        2: GameBudget(seconds = 180, nodes = 750_000_000),
+        3: GameBudget(seconds = 300, nodes = 1_250_000_000),
+    })
+    # candidate plies of a game probed at once, the first one in game order with a puzzle wins
+    probes: int = 1
+    # consecutive depths a rejection must hold for the deep search to stop early, 0 to never stop
+    early_stop_depths: int = 4
+    # no verdict is trusted below that depth
+    early_stop_min_depth: int = 20
+
+    @staticmethod
+    def reference() -> "SearchConfig":
+        """Searches exactly like generator versions without shortcuts, which the recorded test analyses rely on"""
+        return SearchConfig(defense = SearchProfile(2, pair_limit), shallow_limit = None, confirm_limit = None, mate_search = False, restricted_searches = False, prover_max_mate = 0, budgets = {}, early_stop_depths = 0)
+
+class EarlyStop:
+    """
+    Follows the verdict on the winner's move in a streamed multipv 2 search, depth after depth,
+    and tells when a rejection has held long enough to stop searching.
+    Acceptance always waits for the search to complete, the solution moves come from it.
+    """
+
+    def __init__(self, winner: Color, looking_for_mate: bool, depths: int, min_depth: int) -> None:
+        self.winner = winner
+        self.looking_for_mate = looking_for_mate
+        self.depths = depths
+        self.min_depth = min_depth
+        self.depth = 0
+        self.verdict: Optional[str] = None
+        self.stable = 0
+        self.stopped = False
+
+    def verdict_of(self, infos: List[chess.engine.InfoDict]) -> str:
+        scores = [info["score"].pov(self.winner) for info in infos]
+        if len(scores) < 2 or any(score.is_mate() for score in scores):
+            return "unclear"
+        if win_chances(scores[0]) <= win_chances(scores[1]) + 0.7:
+            return "not unique"
+        if not self.looking_for_mate and scores[0] < Cp(200):
+            return "not winning"
+        return "unique"
+
+    def __call__(self, infos: List[chess.engine.InfoDict]) -> bool:
+        depth = infos[-1].get("depth", 0)
+        if depth < self.min_depth or depth == self.depth:
+            return False
+        self.depth = depth
+        verdict = self.verdict_of(infos)
+        self.stable = self.stable + 1 if verdict == self.verdict else 1
+        self.verdict = verdict
+        self.stopped = verdict in ("not unique", "not winning") and self.stable >= self.depths
+        return self.stopped
+
+class Counters(Counter):
+    """Search counts incremented by the threads of a worker process with `add`"""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.lock = threading.Lock()
+
+    def add(self, name: str) -> None:
+        with self.lock:
+            self[name] += 1
+
+    def snapshot(self) -> Dict[str, int]:
+        with self.lock:
+            return dict(self)
+
 class Generator:
-    def __init__(self, engine: SimpleEngine, server: Server):
-        self.engine = engine
+    def __init__(self, engine: Engine, server: Server, tb: Optional[TbChecker] = None, config: SearchConfig = SearchConfig(), stats: Optional[Counters] = None, executor: Optional[ThreadPoolExecutor] = None):
+        self.engine = BudgetedEngine(engine)
         self.server = server
-        self.tb     = TbChecker(logger)
+        self.tb     = tb or TbChecker(logger)
+        self.config = config
+        self.local = threading.local()
+        # search counts, possibly shared with other generators of the process
+        self.stats = Counters() if stats is None else stats
+        # runs the parallel probes, possibly shared with other generators of the process
+        self.executor = executor
+
+    # the prover keeps state during a proof, one per thread probing
+    @property
+    def prover(self) -> MateProver:
+        if not hasattr(self.local, "prover"):
+            self.local.prover = MateProver(self.config.prover_nodes)
+        return self.local.prover
 
     def is_valid_mate_in_one(self, pair: NextMovePair) -> bool:
         if pair.best.score != Mate(1):
@@ -42,11 +174,18 @@ class Generator:
         if pair.second.score == Mate(1):
             # if there's more than one mate in one, gotta look if the best non-mating move is bad enough
             logger.debug('Looking for best non-mating move...')
-            mates = count_mates(copy.deepcopy(pair.node.board()))
-            info = self.engine.analyse(pair.node.board(), multipv = mates + 1, limit = pair_limit)
-            scores =  [pv["score"].pov(pair.winner) for pv in info]
-            # the first non-matein1 move is the last element
-            if scores[-1] < Mate(1) and win_chances(scores[-1]) > non_mate_win_threshold:
+            if self.config.restricted_searches:
+                board = pair.node.board()
+                info = analyse_excluding(self.engine, board, pair_limit, mates_in_one(board))
+                if info is None:
+                    return True
+                score = info["score"].pov(pair.winner)
+            else:
+                mates = count_mates(copy.deepcopy(pair.node.board()))
+                infos = self.engine.analyse(pair.node.board(), multipv = mates + 1, limit = pair_limit)
+                # the first non-matein1 move is the last element
+                score = infos[-1]["score"].pov(pair.winner)
+            if score < Mate(1) and win_chances(score) > non_mate_win_threshold:
                     return False
             return True
         return False
@@ -60,18 +199,100 @@ class Generator:
             win_chances(pair.best.score) > win_chances(pair.second.score) + 0.7
         )
 
-    def get_next_pair(self, node: ChildNode, winner: Color, looking_for_mate: bool) -> Optional[NextMovePair]:
-        pair = self.tb.get_only_winning_move(node, winner, looking_for_mate=looking_for_mate) or get_next_move_pair(self.engine, node, winner, pair_limit)
+    def get_next_pair(self, node: ChildNode, winner: Color, looking_for_mate: bool, predicted: Optional[Move] = None, mate_in: Optional[int] = None) -> Optional[NextMovePair]:
+        pair = (
+            self.prove_mate(node, winner, mate_in) or
+            self.tb.get_only_winning_move(node, winner, looking_for_mate=looking_for_mate) or
+            self.confirm(node, winner, predicted) or
+            self.search_pair(node, winner, looking_for_mate, mate_in)
+        )
         if node.board().turn == winner and not self.is_valid_attack(pair):
             logger.debug("No valid attack {}".format(pair))
             return None
         return pair
 
+    # a short forced mate found by the prover, compared with the best move that doesn't mate as quickly
+    def prove_mate(self, node: ChildNode, winner: Color, mate_in: Optional[int]) -> Optional[NextMovePair]:
+        board = node.board()
+        if not mate_in or mate_in > self.config.prover_max_mate or board.turn != winner:
+            return None
+        mating = self.prover.mating_moves(board, self.config.prover_max_mate)
+        if not mating:
+            self.stats.add("prover gave up" if mating is None else "prover found no mate")
+            return None
+        self.stats.add("prover mates")
+        (move, distance), others = mating[0], mating[1:]
+        best = EngineMove(move, Mate(distance))
+        if distance > 1 and others:
+            return NextMovePair(node, winner, best, EngineMove(others[0][0], Mate(others[0][1])))
+        if not self.config.restricted_searches:
+            # several mates in one are then told apart by is_valid_mate_in_one
+            return NextMovePair(node, winner, best, get_next_move_pair(self.engine, node, winner, pair_limit).second)
+        # any mate in one solves the puzzle, only the best move that doesn't mate in one matters,
+        # longer mates included, as in is_valid_mate_in_one
+        info = analyse_excluding(self.engine, board, pair_limit, mates_in_one(board) if distance == 1 else [move])
+        if info is None:
+            return NextMovePair(node, winner, best, None)
+        return NextMovePair(node, winner, best, EngineMove(info["pv"][0], info["score"].pov(winner)))
+
+    # the defender's reply predicted by the previous search, if a cheap search agrees
+    def confirm(self, node: ChildNode, winner: Color, predicted: Optional[Move]) -> Optional[NextMovePair]:
+        limit = self.config.confirm_limit
+        if not limit or not predicted or node.board().turn == winner:
+            return None
+        self.stats.add("confirm")
+        pair = get_next_move_pair(self.engine, node, winner, limit, multipv = 1)
+        if pair.best.move != predicted:
+            self.stats.add("prediction broken")
+            return None
+        return pair
+
+    def search_pair(self, node: ChildNode, winner: Color, looking_for_mate: bool, mate_in: Optional[int] = None) -> NextMovePair:
+        if node.board().turn != winner:
+            self.stats.add("defense")
+            defense = self.config.defense
+            return get_next_move_pair(self.engine, node, winner, defense.limit, multipv = defense.multipv)
+        attack = self.config.attack
+        if looking_for_mate and mate_in and self.config.mate_search and self.config.restricted_searches:
+            self.stats.add("mate search")
+            mate_limit = chess.engine.Limit(mate = mate_in, depth = mate_search_limit.depth, time = mate_search_limit.time, nodes = mate_search_limit.nodes)
+            found = get_next_move_pair(self.engine, node, winner, mate_limit, multipv = 1)
+            if found.best.score >= Mate(mate_in):
+                # the search stops at the depth the mate is found, too shallow to rule out other moves
+                info = analyse_excluding(self.engine, node.board(), pair_limit, [found.best.move])
+                second = EngineMove(info["pv"][0], info["score"].pov(winner)) if info else None
+                return NextMovePair(node, winner, found.best, second)
+            self.stats.add("mate not confirmed")
+        limit = self.config.shallow_limit
+        if limit:
+            self.stats.add("shallow")
+            pair = get_next_move_pair(self.engine, node, winner, limit)
+            if self.is_shallow_conclusive(pair):
+                self.stats.add("deep avoided")
+                return pair
+        self.stats.add("deep")
+        if not self.config.early_stop_depths:
+            return get_next_move_pair(self.engine, node, winner, attack.limit, multipv = attack.multipv)
+        early_stop = EarlyStop(winner, looking_for_mate, self.config.early_stop_depths, self.config.early_stop_min_depth)
+        pair = get_next_move_pair(self.engine, node, winner, attack.limit, early_stop, attack.multipv)
+        if early_stop.stopped:
+            self.stats.add("deep stopped early")
+        return pair
+
+    # whether `is_valid_attack` can be trusted on a shallow search
+    def is_shallow_conclusive(self, pair: NextMovePair) -> bool:
+        if not pair.second or pair.best.score.is_mate() or pair.second.score.is_mate():
+            return False
+        gap = win_chances(pair.best.score) - win_chances(pair.second.score)
+        return gap < self.config.shallow_reject_gap or gap > self.config.shallow_accept_gap
+
     def get_next_move(self, node: ChildNode, limit: chess.engine.Limit) -> Optional[Move]:
         result = self.engine.play(node.board(), limit = limit)
         return result.move if result else None
 
-    def cook_mate(self, node: ChildNode, winner: Color) -> Optional[List[Move]]:
+    # `mate_in` is how many moves the winner is expected to need, when known.
+    # A first move mating in exactly `unwanted` ends the search, the puzzle would be dropped anyway
+    def cook_mate(self, node: ChildNode, winner: Color, predicted: Optional[Move] = None, mate_in: Optional[int] = None, unwanted: Optional[Score] = None) -> Optional[List[Move]]:
 
         board = node.board()
 
@@ -79,20 +300,32 @@ class Generator:
             return []
 
         if board.turn == winner:
-            pair = self.get_next_pair(node, winner,looking_for_mate=True)
+            pair = self.get_next_pair(node, winner, looking_for_mate=True, mate_in=mate_in)
             if not pair:
                 return None
-            if pair.best.score < mate_soon:
+            mate = pair.best.score.mate()
+            if mate is None or pair.best.score < mate_soon:
                 logger.debug("Best move is not a mate, we're probably not searching deep enough")
                 return None
+            if pair.best.score == unwanted:
+                logger.debug("Mate too short for the tier, aborting")
+                return None
             move = pair.best.move
+            predicted = pair.best.predicted_reply()
+            mate_in = mate - 1
         else:
-            next = self.get_next_move(node, mate_defense_limit)
-            if not next:
-                return None
-            move = next
-
-        follow_up = self.cook_mate(node.add_main_variation(move), winner)
+            defence = self.prover.longest_defence(board, mate_in) if mate_in and mate_in <= self.config.prover_max_mate else None
+            if defence:
+                move, mate_in = defence
+            else:
+                confirmed = self.confirm(node, winner, predicted)
+                next = confirmed.best.move if confirmed else self.get_next_move(node, mate_defense_limit)
+                if not next:
+                    return None
+                move = next
+            predicted = None
+
+        follow_up = self.cook_mate(node.add_main_variation(move), winner, predicted, mate_in)
 
         if follow_up is None:
             return None
@@ -100,7 +333,7 @@ class Generator:
         return [move] + follow_up
 
 
-    def cook_advantage(self, node: ChildNode, winner: Color) -> Optional[List[NextMovePair]]:
+    def cook_advantage(self, node: ChildNode, winner: Color, predicted: Optional[Move] = None) -> Optional[List[NextMovePair]]:
 
         board = node.board()
 
@@ -108,14 +341,14 @@ class Generator:
             logger.debug("Found repetition, canceling")
             return None
 
-        pair = self.get_next_pair(node, winner,looking_for_mate=False)
+        pair = self.get_next_pair(node, winner, looking_for_mate=False, predicted=predicted)
         if not pair:
             return []
         if pair.best.score < Cp(200):
             logger.debug("Not winning enough, aborting")
             return None
 
-        follow_up = self.cook_advantage(node.add_main_variation(pair.best.move), winner)
+        follow_up = self.cook_advantage(node.add_main_variation(pair.best.move), winner, pair.best.predicted_reply())
 
         if follow_up is None:
             return None
@@ -123,60 +356,155 @@ class Generator:
         return [pair] + follow_up
 
 
+    def budget(self, tier: int) -> Budget:
+        tiers = [t for t in self.config.budgets if t <= tier] or list(self.config.budgets)
+        return Budget(self.config.budgets[max(tiers)] if tiers else None)
+
     def analyze_game(self, game: Game, tier: int) -> Optional[Puzzle]:
+        return self.analyze_moves(game.headers.get("Site", "?"), movetext.of_game(game), tier)
+
+    def analyze_moves(self, site: str, moves: movetext.Moves, tier: int) -> Optional[Puzzle]:
+        self.engine.budget = self.budget(tier)
+        try:
+            return self.find_puzzle(site, moves, tier)
+        except BudgetExceeded as e:
+            logger.warning(f'Giving up on slow game {site}, tier {tier}: {e}')
+            self.stats.add("games over budget")
+            return None
+        finally:
+            self.engine.budget = None
+
+    def find_puzzle(self, site: str, moves: movetext.Moves, tier: int) -> Optional[Puzzle]:
+
+        logger.debug(f'Analyzing tier {tier} {site}...')
+
+        candidates = self.candidates(site, moves, tier)
+        seen = self.server.are_seen_pos([node for node, _ in candidates]) if candidates else set()
+        for node, _ in candidates:
+            if position_key(node) in seen:
+                logger.debug("Skip duplicate position {}".format(node.ply()))
+        puzzle = self.probe_first([(node, score) for node, score in candidates if position_key(node) not in seen], tier)
+
+        if not puzzle:
+            logger.debug("Found nothing from {}".format(site))
 
-        logger.debug(f'Analyzing tier {tier} {game.headers.get("Site")}...')
+        return puzzle
 
+    # the plies worth probing, with their score. They only depend on the game evals, not on any search.
+    # Boards are only played up to the last ply the evals make a candidate
+    def candidates(self, site: str, moves: movetext.Moves, tier: int) -> List[Tuple[ChildNode, Score]]:
+
+        candidates: List[Tuple[ChildNode, Score]] = []
+        mask = movetext.candidate_mask(moves.evals, tier)
+        last = int(np.flatnonzero(mask)[-1]) if mask.any() else -1
         prev_score: Score = Cp(20)
+        # whether prev_score is another ply's than the mask assumed
+        stale = False
         seen_epds: Set[str] = set()
-        board = game.board()
+        board = chess.Board(moves.fen)
         skip_until_irreversible = False
 
-        for node in game.mainline():
+        for ply in range(len(moves)):
+            if ply > last and not stale:
+                break
+
+            move = moves.move(board, ply)
+
             if skip_until_irreversible:
-                if board.is_irreversible(node.move):
+                if board.is_irreversible(move):
                     skip_until_irreversible = False
                     seen_epds.clear()
                 else:
-                    board.push(node.move)
+                    board.push(move)
                     continue
 
-            current_eval = node.eval()
-
-            if not current_eval:
-                logger.debug("Skipping game without eval on ply {}".format(node.ply()))
-                return None
+            if ply >= len(moves.evals):
+                logger.debug("Skipping game without eval on ply {}".format(ply + 1))
+                break
 
-            board.push(node.move)
+            board.push(move)
             epd = board.epd()
             if epd in seen_epds:
                 skip_until_irreversible = True
+                stale = True
                 continue
             seen_epds.add(epd)
 
             if board.castling_rights != maximum_castling_rights(board):
+                stale = True
                 continue
 
-            result = self.analyze_position(node, prev_score, current_eval, tier)
-
-            if isinstance(result, Puzzle):
-                return result
-
-            prev_score = -result
-
-        logger.debug("Found nothing from {}".format(game.headers.get("Site")))
-
-        return None
-
+            score = movetext.decode(int(moves.evals[ply])).pov(board.turn)
+            if mask[ply] or stale:
+                node = self.node(site, board)
+                if self.is_candidate(node, prev_score, score, tier):
+                    candidates.append((node, score))
+
+            prev_score = -score
+            stale = False
+
+        return candidates
+
+    def node(self, site: str, board: chess.Board) -> ChildNode:
+        game = Game.from_board(board)
+        game.headers["Site"] = site
+        node = game.end()
+        assert isinstance(node, ChildNode)
+        return node
+
+    # the puzzle of the first candidate in game order that has one
+    def probe_first(self, candidates: List[Tuple[ChildNode, Score]], tier: int) -> Optional[Puzzle]:
+        if self.config.probes < 2 or len(candidates) < 2:
+            for node, score in candidates:
+                puzzle = self.probe(node, score, tier)
+                if puzzle:
+                    return puzzle
+            return None
+        game_budget = self.engine.budget or Budget(None)
+        budgets = [game_budget.probe() for _ in candidates]
+        if not self.executor:
+            self.executor = ThreadPoolExecutor(self.config.probes)
+        futures = [self.executor.submit(self.probe_within, budget, node, score, tier) for budget, (node, score) in zip(budgets, candidates)]
+        try:
+            for future in futures:
+                puzzle = future.result()
+                if puzzle:
+                    return puzzle
+            return None
+        finally:
+            # later candidates give up before their next search, which is waited for to free their engines
+            for future, budget in zip(futures, budgets):
+                future.cancel()
+                budget.cancel()
+            wait(futures)
+
+    def probe_within(self, budget: ProbeBudget, node: ChildNode, score: Score, tier: int) -> Optional[Puzzle]:
+        self.engine.budget = budget
+        try:
+            return self.probe(node, score, tier)
+        except Cancelled:
+            self.stats.add("probes cancelled")
+            return None
+        finally:
+            self.engine.budget = None
 
     def analyze_position(self, node: ChildNode, prev_score: Score, current_eval: PovScore, tier: int) -> Union[Puzzle, Score]:
+        score = current_eval.pov(node.board().turn)
+        if not self.is_candidate(node, prev_score, score, tier):
+            return score
+        if self.server.is_seen_pos(node):
+            logger.debug("Skip duplicate position")
+            return score
+        return self.probe(node, score, tier) or score
+
+    # whether the position is worth probing, from the game evals alone
+    def is_candidate(self, node: ChildNode, prev_score: Score, score: Score, tier: int) -> bool:
 
         board = node.board()
         winner = board.turn
-        score = current_eval.pov(winner)
 
         if board.legal_moves.count() < 2:
-            return score
+            return False
 
         game_url = node.game().headers.get("Site")
 
@@ -184,78 +512,182 @@ class Generator:
 
         if prev_score > Cp(300) and score < mate_soon:
             logger.debug("{} Too much of a winning position to start with {} -> {}".format(node.ply(), prev_score, score))
-            return score
+            return False
         if is_up_in_material(board, winner):
             logger.debug("{} already up in material {} {} {}".format(node.ply(), winner, material_count(board, winner), material_count(board, not winner)))
-            return score
+            return False
         elif score >= Mate(1) and tier < 3:
             logger.debug("{} mate in one".format(node.ply()))
-            return score
+            return False
+        elif score == Mate(2) and tier == 1:
+            logger.debug("{} mate in two".format(node.ply()))
+            return False
         elif score > mate_soon:
             logger.debug("Mate {}#{} Probing...".format(game_url, node.ply()))
-            if self.server.is_seen_pos(node):
-                logger.debug("Skip duplicate position")
-                return score
-            mate_solution = self.cook_mate(copy.deepcopy(node), winner)
-            if mate_solution is None or (tier == 1 and len(mate_solution) == 3):
-                return score
-            return Puzzle(node, mate_solution, 999999999)
+            return True
         elif score >= Cp(200) and win_chances(score) > win_chances(prev_score) + 0.6:
             if score < Cp(400) and material_diff(board, winner) > -1:
                 logger.debug("Not clearly winning and not from being down in material, aborting")
-                return score
+                return False
             logger.debug("Advantage {}#{} {} -> {}. Probing...".format(game_url, node.ply(), prev_score, score))
-            if self.server.is_seen_pos(node):
-                logger.debug("Skip duplicate position")
-                return score
-            puzzle_node = copy.deepcopy(node)
-            solution : Optional[List[NextMovePair]] = self.cook_advantage(puzzle_node, winner)
-            self.server.set_seen(node.game())
-            if not solution:
-                return score
-            while len(solution) % 2 == 0 or not solution[-1].second:
-                if not solution[-1].second:
-                    logger.debug("Remove final only-move")
-                solution = solution[:-1]
-            if not solution or len(solution) == 1 :
-                logger.debug("Discard one-mover")
-                return score
-            if tier < 3 and len(solution) == 3:
-                logger.debug("Discard two-mover")
-                return score
-            cp = solution[len(solution) - 1].best.score.score()
-            return Puzzle(node, [p.best.move for p in solution], 999999998 if cp is None else cp)
+            return True
         else:
-            return score
+            return False
 
+    def probe(self, node: ChildNode, score: Score, tier: int) -> Optional[Puzzle]:
+        winner = node.board().turn
+        if score > mate_soon:
+            mate_solution = self.cook_mate(copy.deepcopy(node), winner, mate_in = score.mate(), unwanted = Mate(2) if tier == 1 else None)
+            if mate_solution is None or (tier == 1 and len(mate_solution) == 3):
+                return None
+            return Puzzle(node, mate_solution, 999999999)
+        puzzle_node = copy.deepcopy(node)
+        solution : Optional[List[NextMovePair]] = self.cook_advantage(puzzle_node, winner)
+        self.server.set_seen(node.game())
+        if not solution:
+            return None
+        while len(solution) % 2 == 0 or not solution[-1].second:
+            if not solution[-1].second:
+                logger.debug("Remove final only-move")
+            solution = solution[:-1]
+        if not solution or len(solution) == 1 :
+            logger.debug("Discard one-mover")
+            return None
+        if tier < 3 and len(solution) == 3:
+            logger.debug("Discard two-mover")
+            return None
+        cp = solution[len(solution) - 1].best.score.score()
+        return Puzzle(node, [p.best.move for p in solution], 999999998 if cp is None else cp)
 
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(
         prog='generator.py',
         description='takes a pgn file and produces chess puzzles')
-    parser.add_argument("--file", "-f", help="input PGN file", required=True, metavar="FILE.pgn")
+    parser.add_argument("--file", "-f", help="input PGN file, shard written by extract.py or game file written by gamebin.py", required=True, metavar="FILE.pgn")
     parser.add_argument("--engine", "-e", help="analysis engine", default="./stockfish")
-    parser.add_argument("--threads", "-t", help="count of cpu threads for engine searches", default="4")
+    parser.add_argument("--threads", "-t", help="count of cpu threads for each engine", default="4")
+    parser.add_argument("--workers", "-w", help="count of worker processes, each running its own engines", default="1")
+    parser.add_argument("--engines", help="count of engines in each worker process", default="1")
+    parser.add_argument("--concurrency", help="count of games each worker process analyses at once, defaults to --engines")
+    parser.add_argument("--queue", help="how many games the reader may get ahead of the workers", default="64")
+    parser.add_argument("--prefetch", help="how many upcoming games to check against the server's seen list at once", default="200")
     parser.add_argument("--url", "-u", help="URL where to post puzzles", default="http://localhost:8000")
     parser.add_argument("--token", help="Server secret token", default="changeme")
     parser.add_argument("--skip", help="How many games to skip from the source", default="0")
+    parser.add_argument("--cache", help="SQLite file caching engine analysis and tablebase responses, shared by all workers, e.g. analysis.sqlite. Disabled by default", default="")
+    parser.add_argument("--cache-size", help="how many analysis results the cache keeps", default="5000000")
+    parser.add_argument("--seen", help="local seen store built by seen.py, answering seen lookups it misses instead of the server", metavar="FILE.store")
+    parser.add_argument("--spool", help="directory where puzzles wait to be posted", default="spool")
+    parser.add_argument("--syzygy", help="directory of local syzygy tables, probed before the tablebase API", metavar="DIR")
+    parser.add_argument("--shallow-reject", help="win chances gap between the two best moves of the shallow search below which an attack is rejected without a deep search", default=str(SearchConfig.shallow_reject_gap))
+    parser.add_argument("--shallow-accept", help="gap above which the shallow search is trusted. 2 or more never trusts it", default=str(SearchConfig.shallow_accept_gap))
+    parser.add_argument("--no-shallow", help="always search at full depth", action="store_true")
+    parser.add_argument("--no-confirm", help="always search the defender's replies in full, instead of confirming the ones predicted by the previous search", action="store_true")
+    parser.add_argument("--no-mate-search", help="look for mates with the usual search limits instead of `go mate`", action="store_true")
+    parser.add_argument("--prover", help="longest mates proven without the engine, 0 to disable", default=str(SearchConfig.prover_max_mate))
+    parser.add_argument("--probes", help="candidate plies of a game probed at once. Defaults to --engines divided by --concurrency")
+    parser.add_argument("--no-budget", help="let games use as much engine time as they need", action="store_true")
+    parser.add_argument("--early-stop", help="consecutive depths over which a rejected attack must stay rejected to stop its search. 0 to always complete searches", default=str(SearchConfig.early_stop_depths))
+    parser.add_argument("--window", help="games read ahead and fed to the workers by expected puzzles instead of source order, from a game file only. 0 keeps the source order", default="0")
+    parser.add_argument("--readers", help="processes decompressing a zstd file rewritten by frames.py at once", default="1")
+    parser.add_argument("--checkpoint", help="file where to save progress, and resume from. Defaults to FILE.checkpoint in the current directory", metavar="FILE.checkpoint")
     parser.add_argument("--verbose", "-v", help="increase verbosity", action="count")
-    parser.add_argument("--parts", help="how many parts", default="8")
-    parser.add_argument("--part", help="which one of the parts", default="0")
 
     return parser.parse_args()
 
 
+def search_config(args: argparse.Namespace) -> SearchConfig:
+    config = SearchConfig(shallow_reject_gap = float(args.shallow_reject), shallow_accept_gap = float(args.shallow_accept), mate_search = not args.no_mate_search, prover_max_mate = int(args.prover), early_stop_depths = int(args.early_stop), probes = int(args.probes or max(1, int(args.engines) // int(args.concurrency or args.engines))))
+    if args.no_budget:
+        config = replace(config, budgets = {})
+    if args.no_confirm:
+        config = replace(config, confirm_limit = None)
+    return replace(config, shallow_limit = None) if args.no_shallow else config
+
+
 def make_engine(executable: str, threads: int) -> SimpleEngine:
     engine = SimpleEngine.popen_uci(executable)
     engine.configure({'Threads': threads})
     return engine
 
 
-def open_file(file: str):
-    if file.endswith(".zst"):
-        return zstandard.open(file, "rt")
-    return open(file)
+class GameWorker:
+    """
+    Analyses games against a pool of engines, possibly several games at once
+    from different threads, each with its own `Generator`.
+    """
+
+    def __init__(self, args: argparse.Namespace) -> None:
+        self.file = args.file
+        self.syzygy = args.syzygy
+        self.pool = EnginePool(args.engine, int(args.engines), int(args.threads))
+        self.cache = AnalysisCache(args.cache, int(args.cache_size)) if args.cache else None
+        self.tb_cache = TablebaseCache(args.cache) if args.cache else None
+        self.server = Server(logger, args.url, args.token, version, SeenStore(args.seen) if args.seen else None, args.spool)
+        self.config = search_config(args)
+        self.stats = Counters()
+        self.local = threading.local()
+        # shared by the games analysed at once, each probing up to `probes` plies at once
+        concurrency = int(args.concurrency or args.engines)
+        self.executor = ThreadPoolExecutor(concurrency * self.config.probes) if self.config.probes > 1 else None
+        # games are then sent by index, and their moves read here
+        self.games = GameFile(args.file) if args.file.endswith(GAME_FILE_SUFFIX) else None
+
+    @property
+    def generator(self) -> Generator:
+        if not hasattr(self.local, "generator"):
+            engine: Engine = PooledEngine(self.pool)
+            if self.cache:
+                engine = CachingEngine(engine, self.cache)
+            self.local.generator = Generator(engine, self.server, TbChecker(logger, self.syzygy, self.tb_cache), self.config, self.stats, self.executor)
+        return self.local.generator
+
+    def process(self, raw: RawGame) -> bool:
+        moves = self.games.moves(raw.index - 1) if self.games else movetext.parse(raw.movetext)
+        tier = util.game_tier(raw.tier, raw.has_master, len(moves))
+        # logger.info(f'https://lichess.org/{raw.id} tier {tier}')
+        try:
+            puzzle = self.generator.analyze_moves(raw.site, moves, tier)
+            if puzzle is not None:
+                logger.info(f'v{version} {self.file} {util.avg_knps()} knps, tier {tier}, game {raw.index}')
+                self.server.post(raw.id, puzzle)
+                return True
+        except Exception as e:
+            logger.error("Exception on {}: {}".format(raw.id, e))
+        return False
+
+    def knps(self) -> int:
+        return util.avg_knps()
+
+    def counters(self) -> Dict[str, int]:
+        return self.stats.snapshot()
+
+    def close(self) -> None:
+        if self.executor:
+            self.executor.shutdown()
+        self.pool.close()
+        self.server.close()
+
+
+Source = Union[PgnSource, GameFileSource, FramedSource]
+
+def open_source(args: argparse.Namespace, checkpoint: Optional[Checkpoint]) -> Source:
+    if args.file.endswith(GAME_FILE_SUFFIX):
+        return GameFileSource(args.file, checkpoint)
+    frames = load_index(f"{args.file}{INDEX_SUFFIX}") if int(args.readers) > 1 else None
+    if frames:
+        return FramedSource(args.file, frames, int(args.readers), checkpoint)
+    return PgnSource(args.file, checkpoint)
+
+def make_scheduler(args: argparse.Namespace) -> Optional[Scheduler]:
+    if not int(args.window):
+        return None
+    if not args.file.endswith(GAME_FILE_SUFFIX):
+        # the feeder would parse every movetext the workers parse again
+        logger.warning('Ignoring --window, which needs a game file built by gamebin.py')
+        return None
+    games = GameFile(args.file)
+    return Scheduler(int(args.window), lambda raw: games.moves(raw.index - 1))
 
 def main() -> None:
     sys.setrecursionlimit(10000) # else node.deepcopy() sometimes fails?
@@ -264,79 +696,56 @@ def main() -> None:
         logger.setLevel(logging.DEBUG)
     else:
         logger.setLevel(logging.INFO)
-    engine = make_engine(args.engine, args.threads)
-    server = Server(logger, args.url, args.token, version)
-    generator = Generator(engine, server)
+    server = Server(logger, args.url, args.token, version, SeenStore(args.seen) if args.seen else None)
+    orchestrator = Orchestrator(logger, int(args.workers), int(args.queue), int(args.concurrency or args.engines))
+    checkpoint_path = args.checkpoint or "{}.checkpoint".format(os.path.basename(args.file))
+    checkpoint = load_checkpoint(checkpoint_path)
+    if checkpoint and checkpoint.version != version:
+        logger.info(f'Ignoring checkpoint of v{checkpoint.version}')
+        checkpoint = None
+    if checkpoint:
+        logger.info(f'Resuming after game {checkpoint.games}, offset {checkpoint.offset}')
     games = 0
-    site = "?"
-    has_master = False
-    tier = 0
     skip = int(args.skip)
+    prefetch = int(args.prefetch)
     logger.info("Skipping first {} games".format(skip))
 
-    parts = int(args.parts)
-    part = int(args.part)
-    print(f'v{version} {args.file} {part}/{parts}')
+    print(f'v{version} {args.file} {args.workers} workers')
+
+    def drop_seen(batch: List[RawGame]) -> Iterator[RawGame]:
+        seen = server.are_seen([raw.id for raw in batch])
+        for raw in batch:
+            if raw.id in seen:
+                logger.info(f'Game {raw.id} was already seen before, skipping - {raw.index}')
+            else:
+                yield raw
+
+    def unseen_games(source: Source) -> Iterator[RawGame]:
+        nonlocal games
+        batch: List[RawGame] = []
+        for raw in source.games():
+            games = raw.index
+            if games < skip:
+                continue
+            batch.append(raw)
+            if len(batch) >= prefetch:
+                yield from drop_seen(batch)
+                batch = []
+        yield from drop_seen(batch)
 
     try:
-        with open_file(args.file) as pgn:
-            skip_next = False
-            for line in pgn:
-                if line.startswith("[Site "):
-                    site = line
-                    games = games + 1
-                    has_master = False
-                    tier = 4
-                elif games < skip:
-                    continue
-                elif games % parts != part - 1:
-                    continue
-                if tier == 0:
-                    skip_next = True
-                elif line.startswith("[Variant ") and not line.startswith("[Variant \"Standard\"]"):
-                    skip_next = True
-                elif (
-                        (line.startswith("[WhiteTitle ") or line.startswith("[BlackTitle ")) and
-                        "BOT" not in line
-                    ):
-                    has_master = True
-                else:
-                    r_tier = util.rating_tier(line)
-                    t_tier = util.time_control_tier(line)
-                    if r_tier is not None:
-                        tier = min(tier, r_tier)
-                    elif t_tier is not None:
-                        tier = min(tier, t_tier)
-                    elif line.startswith("1. ") and skip_next:
-                        logger.debug("Skip {}".format(site))
-                        skip_next = False
-                    elif "%eval" in line:
-                        tier = tier + 1 if has_master else tier
-                        game = chess.pgn.read_game(StringIO("{}\n{}".format(site, line)))
-                        assert(game)
-                        nb_moves = len(list(game.mainline_moves()))
-                        tier = tier + 1 if nb_moves < 38 else tier
-                        tier = tier + 1 if nb_moves < 21 else tier
-                        game_id = game.headers.get("Site", "?")[20:]
-                        if server.is_seen(game_id):
-                            to_skip = 1000
-                            logger.info(f'Game {game_id} was already seen before, skipping {to_skip} - {games}')
-                            skip = games + to_skip
-                            continue
-
-                        # logger.info(f'https://lichess.org/{game_id} tier {tier}')
-                        try:
-                            puzzle = generator.analyze_game(game, tier)
-                            if puzzle is not None:
-                                logger.info(f'v{version} {args.file} {part}/{parts} {util.avg_knps()} knps, tier {tier}, game {games}')
-                                server.post(game_id, puzzle)
-                        except Exception as e:
-                            logger.error("Exception on {}: {}".format(game_id, e))
+        with open_source(args, checkpoint) as source:
+            scheduler = make_scheduler(args)
+
+            def on_checkpoint(raw: RawGame, after: bool) -> None:
+                if scheduler:
+                    raw, after = scheduler.resume(raw, after)
+                save_checkpoint(checkpoint_path, source.checkpoint_at(raw, version, after))
+
+            orchestrator.run(scheduler(unseen_games(source)) if scheduler else unseen_games(source), partial(GameWorker, args), on_checkpoint)
     except KeyboardInterrupt:
         print(f'v{version} {args.file} Game {games}')
         sys.exit(1)
 
-    engine.close()
-
 if __name__ == "__main__":
     main()
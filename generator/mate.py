@@ -0,0 +1,114 @@
+from chess import Board, Move
+from typing import Dict, List, Optional, Tuple
+
+class OutOfNodes(Exception):
+    pass
+
+class MateProver:
+    """
+    Proves short forced mates by exhaustive search, without an engine.
+    Gives up, returning None, after visiting `max_nodes` positions.
+    """
+
+    def __init__(self, max_nodes: int = 100_000) -> None:
+        self.max_nodes = max_nodes
+        self.nodes = 0
+        # whether the side to move mates within a number of moves, by position
+        self.known: Dict[Tuple[object, int], bool] = {}
+
+    def _start(self) -> None:
+        self.nodes = 0
+        if len(self.known) > 1_000_000:
+            self.known.clear()
+
+    def mating_moves(self, board: Board, n: int) -> Optional[List[Tuple[Move, int]]]:
+        """The moves mating within `n` moves, with their mate distance, shortest first"""
+        self._start()
+        board = board.copy(stack = False)
+        try:
+            found: List[Tuple[Move, int]] = []
+            for move in ordered(board):
+                board.push(move)
+                distance = 1 if board.is_checkmate() else self._defence_distance(board, n - 1)
+                board.pop()
+                if distance is not None:
+                    found.append((move, distance))
+            return sorted(found, key = lambda found: (found[1], found[0].uci()))
+        except OutOfNodes:
+            return None
+
+    def longest_defence(self, board: Board, n: int) -> Optional[Tuple[Move, int]]:
+        """
+        The reply delaying mate the most, with the mate distance after it,
+        if the opponent mates within `n` moves whatever the reply.
+        Among equally long defences, the first in UCI order is picked.
+        """
+        self._start()
+        board = board.copy(stack = False)
+        try:
+            longest: Optional[Tuple[Move, int]] = None
+            for move in sorted(board.legal_moves, key = Move.uci):
+                board.push(move)
+                distance = self._distance(board, n)
+                board.pop()
+                if distance is None:
+                    return None
+                if not longest or distance > longest[1]:
+                    longest = (move, distance)
+            return longest
+        except OutOfNodes:
+            return None
+
+    # shortest mate of the side to move within n moves
+    def _distance(self, board: Board, n: int) -> Optional[int]:
+        for k in range(1, n + 1):
+            if self._mates(board, k):
+                return k
+        return None
+
+    # mate distance counted from the move before, if every reply of the side to move loses within n moves
+    def _defence_distance(self, board: Board, n: int) -> Optional[int]:
+        if n < 1 or board.is_game_over():
+            return None
+        for k in range(1, n + 1):
+            if self._all_replies_lose(board, k):
+                return k + 1
+        return None
+
+    def _mates(self, board: Board, n: int) -> bool:
+        key = (board._transposition_key(), n)
+        if key in self.known:
+            return self.known[key]
+        mates = False
+        for move in (checks(board) if n == 1 else ordered(board)):
+            self._visit()
+            board.push(move)
+            if board.is_checkmate() or (n > 1 and not board.is_game_over() and self._all_replies_lose(board, n - 1)):
+                mates = True
+            board.pop()
+            if mates:
+                break
+        self.known[key] = mates
+        return mates
+
+    def _all_replies_lose(self, board: Board, n: int) -> bool:
+        for move in list(board.legal_moves):
+            self._visit()
+            board.push(move)
+            loses = self._mates(board, n)
+            board.pop()
+            if not loses:
+                return False
+        return True
+
+    def _visit(self) -> None:
+        self.nodes += 1
+        if self.nodes > self.max_nodes:
+            raise OutOfNodes()
+
+def checks(board: Board) -> List[Move]:
+    return [move for move in board.legal_moves if board.gives_check(move)]
+
+# checks, then captures, then the rest: mates are usually found early
+def ordered(board: Board) -> List[Move]:
+    return sorted(board.legal_moves, key = lambda move: (not board.gives_check(move), not board.is_capture(move)))
@@ -1,7 +1,7 @@
 from chess.pgn import GameNode, ChildNode
 from chess import Move, Color
 from chess.engine import Score
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import Tuple, List, Optional
 
 @dataclass
@@ -20,6 +20,11 @@ class Line:
 class EngineMove:
     move: Move
     score: Score
+    # principal variation starting with `move`, when known
+    pv: List[Move] = field(default_factory=list)
+
+    def predicted_reply(self) -> Optional[Move]:
+        return self.pv[1] if len(self.pv) > 1 else None
 
 @dataclass
 class NextMovePair:
@@ -32,4 +37,27 @@ class NextMovePair:
 @dataclass
 class TbPair(NextMovePair):
     # `True` if the position is winning and only one move wins
-    only_winning_move: bool
\ No newline at end of file
+    only_winning_move: bool
+
+# A game that went through the header pre-filter, movetext still undecoded
+@dataclass
+class RawGame:
+    # 1-based position of the game in the source file
+    index: int
+    # offset of the game start in the decompressed source
+    offset: int
+    site: str
+    tier: int
+    has_master: bool
+    movetext: bytes
+    # 0 when unknown
+    white_elo: int = 0
+    black_elo: int = 0
+    # base seconds and increment
+    time_control: Tuple[int, int] = (0, 0)
+    # offset of the game end in the decompressed source, 0 when unknown
+    end: int = 0
+
+    @property
+    def id(self) -> str:
+        return self.site[20:]
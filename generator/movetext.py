@@ -0,0 +1,116 @@
+import re
+import chess
+import numpy as np
+from chess.engine import Cp, Mate, PovScore, Score
+from chess.pgn import Game
+from dataclasses import dataclass
+from typing import List, Optional
+
+# evals are stored as int16 centipawns from white's point of view, mates as ±(MATE - moves to mate),
+# which keeps them in the same order as python-chess scores
+MATE = 32000
+MAX_CP = 30000
+MATE_SOON = MATE - 15
+
+TOKEN = re.compile(rb"\{[^}]*\}|[()]|\$\d+|\d+\.+|[^\s{}()$]+")
+EVAL = re.compile(rb"\[%eval ([^\]\s]+)")
+RESULTS = {b"1-0", b"0-1", b"1/2-1/2", b"*"}
+
+@dataclass
+class Moves:
+    """The mainline of a game, without the game tree"""
+    sans: List[str]
+    # one per move, up to the first move without an eval
+    evals: np.ndarray
+    fen: str = chess.STARTING_FEN
+    # moves encoded by `encode_move`, in place of `sans` when read from a game file
+    codes: Optional[np.ndarray] = None
+
+    def __len__(self) -> int:
+        return len(self.sans) if self.codes is None else len(self.codes)
+
+    def move(self, board: chess.Board, ply: int) -> chess.Move:
+        return board.parse_san(self.sans[ply]) if self.codes is None else decode_move(int(self.codes[ply]))
+
+def parse(movetext: bytes) -> Moves:
+    """Mainline moves and evals of PGN movetext, skipping variations and other comments"""
+    sans: List[str] = []
+    evals: List[Optional[int]] = []
+    depth = 0
+    for match in TOKEN.finditer(movetext):
+        token = match.group()
+        if token == b"(":
+            depth += 1
+        elif token == b")":
+            depth -= 1
+        elif depth or token[0] == ord("$") or token[0:1].isdigit() and token.endswith(b"."):
+            continue
+        elif token[0] == ord("{"):
+            found = EVAL.search(token)
+            if sans and evals[-1] is None and found:
+                evals[-1] = encode(found.group(1))
+        elif token in RESULTS:
+            break
+        else:
+            sans.append(token.rstrip(b"?!").decode())
+            evals.append(None)
+    known = evals.index(None) if None in evals else len(evals)
+    return Moves(sans, np.array(evals[:known], dtype = np.int16))
+
+def of_game(game: Game) -> Moves:
+    sans: List[str] = []
+    evals: List[int] = []
+    for node in game.mainline():
+        sans.append(node.san())
+        score = node.eval()
+        if score and len(evals) == len(sans) - 1:
+            evals.append(encode_score(score.white()))
+    return Moves(sans, np.array(evals, dtype = np.int16), game.board().fen())
+
+# from and to squares, then the promotion piece type, in 15 bits
+def encode_move(move: chess.Move) -> int:
+    return move.from_square | move.to_square << 6 | (move.promotion or 0) << 12
+
+def decode_move(code: int) -> chess.Move:
+    return chess.Move(code & 63, code >> 6 & 63, code >> 12 or None)
+
+def encode(value: bytes) -> int:
+    if value.startswith(b"#"):
+        mate = int(value[1:])
+        return MATE - mate if mate > 0 else -MATE - mate
+    # truncated, as by `chess.pgn.GameNode.eval`
+    return max(-MAX_CP, min(MAX_CP, int(float(value) * 100)))
+
+def encode_score(score: Score) -> int:
+    mate = score.mate()
+    if mate is not None:
+        return MATE - mate if mate > 0 else -MATE - mate
+    return max(-MAX_CP, min(MAX_CP, score.score() or 0))
+
+def decode(value: int) -> PovScore:
+    if abs(value) > MAX_CP:
+        return PovScore(Mate(MATE - value if value > 0 else -MATE - value), chess.WHITE)
+    return PovScore(Cp(value), chess.WHITE)
+
+def win_chances(scores: np.ndarray) -> np.ndarray:
+    """`util.win_chances` over encoded scores"""
+    cp = np.clip(scores, -MAX_CP, MAX_CP).astype(np.float64)
+    chances = 2 / (1 + np.exp(-0.00368208 * cp)) - 1
+    return np.where(np.abs(scores) > MAX_CP, np.sign(scores), chances)
+
+def candidate_mask(evals: np.ndarray, tier: int) -> np.ndarray:
+    """
+    Plies which `Generator.is_candidate` may accept, from the evals alone: the rules needing
+    a board, e.g. material, are left to it. A ply following plies skipped by the generator
+    is judged against an older score there, and must be checked regardless of the mask.
+    """
+    # as in analyze_position, scores are seen from the side to move after each ply
+    side = np.where(np.arange(1, len(evals) + 1) % 2 == 0, 1, -1)
+    score = evals.astype(np.int32) * side
+    prev = np.concatenate(([20], -score[:-1])).astype(np.int32)
+    too_winning = (prev > 300) & (score < MATE_SOON)
+    too_short = (score >= MATE - 1) & (tier < 3) | (score == MATE - 2) & (tier == 1)
+    mate = score > MATE_SOON
+    # slightly lenient, the exact threshold is applied on the candidates
+    advantage = (score >= 200) & (win_chances(score) > win_chances(prev) + 0.6 - 1e-9)
+    return ~too_winning & ~too_short & (mate | advantage)
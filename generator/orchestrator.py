@@ -0,0 +1,162 @@
+import logging
+import multiprocessing
+import queue
+import threading
+import time
+from dataclasses import dataclass, field
+from model import RawGame
+from typing import Callable, Dict, Iterator, List, Optional, Protocol
+
+class Worker(Protocol):
+
+    def process(self, raw: RawGame) -> bool: ...
+
+    def knps(self) -> int: ...
+
+    def counters(self) -> Dict[str, int]: ...
+
+    def close(self) -> None: ...
+
+@dataclass
+class Report:
+    worker: int
+    index: int
+    found: bool
+    seconds: float
+    knps: int
+    # running totals of the worker process, e.g. searches made
+    counters: Dict[str, int]
+
+@dataclass
+class WorkerStats:
+    games: int = 0
+    puzzles: int = 0
+    seconds: float = 0
+    knps: int = 0
+    counters: Dict[str, int] = field(default_factory=dict)
+
+    def add(self, report: Report) -> None:
+        self.games += 1
+        self.puzzles += 1 if report.found else 0
+        self.seconds += report.seconds
+        self.knps = report.knps
+        self.counters = report.counters
+
+    def __str__(self) -> str:
+        per_minute = self.games * 60 / self.seconds if self.seconds else 0
+        counters = "".join(f", {value} {name}" for name, value in sorted(self.counters.items()))
+        return f"{self.games} games, {self.puzzles} puzzles, {per_minute:.1f} games/min, {self.knps} knps{counters}"
+
+def work(id: int, make_worker: Callable[[], Worker], concurrency: int, games: "multiprocessing.Queue[Optional[RawGame]]", reports: "multiprocessing.Queue[Report]") -> None:
+    worker = make_worker()
+
+    def loop() -> None:
+        while True:
+            raw = games.get()
+            if raw is None:
+                break
+            start = time.monotonic()
+            found = worker.process(raw)
+            reports.put(Report(id, raw.index, found, time.monotonic() - start, worker.knps(), worker.counters()))
+
+    threads = [threading.Thread(target=loop, daemon=True) for _ in range(concurrency)]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        worker.close()
+
+class Orchestrator:
+    """
+    Reads the source once and fans games out to a pool of worker processes,
+    each owning its own engines and analysing up to `concurrency` games at once.
+    Bounded queues keep the reader at most `queue_size` games ahead of the workers.
+    """
+
+    def __init__(self, logger: logging.Logger, workers: int, queue_size: int, concurrency: int = 1, report_every: float = 60, checkpoint_every: float = 60) -> None:
+        self.logger = logger
+        self.nb_workers = workers
+        self.concurrency = concurrency
+        self.games: "multiprocessing.Queue[Optional[RawGame]]" = multiprocessing.Queue(queue_size)
+        self.reports: "multiprocessing.Queue[Report]" = multiprocessing.Queue()
+        self.report_every = report_every
+        self.stats: Dict[int, WorkerStats] = {}
+        self.last_report = time.monotonic()
+        # games handed to the workers and not reported back yet, by index
+        self.pending: Dict[int, RawGame] = {}
+        self.last_fed: Optional[RawGame] = None
+        self.checkpoint_every = checkpoint_every
+        self.last_checkpoint = time.monotonic()
+        self.on_checkpoint: Optional[Callable[[RawGame, bool], None]] = None
+
+    def run(self, games: Iterator[RawGame], make_worker: Callable[[], Worker], on_checkpoint: Optional[Callable[[RawGame, bool], None]] = None) -> None:
+        """
+        `on_checkpoint` is called periodically with the oldest game
+        not fully processed yet, from which a new run can safely resume.
+        Once every game fed is processed, it is called with the last one fed
+        and `True`, to resume after it.
+        """
+        self.on_checkpoint = on_checkpoint
+        processes: List[multiprocessing.Process] = []
+        for id in range(self.nb_workers):
+            self.stats[id] = WorkerStats()
+            process = multiprocessing.Process(target=work, args=(id, make_worker, self.concurrency, self.games, self.reports), daemon=True)
+            process.start()
+            processes.append(process)
+        try:
+            for raw in games:
+                self.pending[raw.index] = raw
+                self.last_fed = raw
+                self._feed(raw)
+            for _ in range(self.nb_workers * self.concurrency):
+                self._feed(None)
+            while any(p.is_alive() for p in processes):
+                self._drain(timeout = 1)
+            self._drain()
+        finally:
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+            self.checkpoint()
+            self.log_stats()
+
+    def _feed(self, raw: Optional[RawGame]) -> None:
+        while True:
+            self._drain()
+            try:
+                self.games.put(raw, timeout = 1)
+                return
+            except queue.Full:
+                continue
+
+    def _drain(self, timeout: float = 0) -> None:
+        try:
+            while True:
+                report = self.reports.get(timeout = timeout) if timeout else self.reports.get_nowait()
+                self.stats[report.worker].add(report)
+                self.pending.pop(report.index, None)
+                timeout = 0
+        except queue.Empty:
+            pass
+        if time.monotonic() - self.last_report > self.report_every:
+            self.log_stats()
+        if time.monotonic() - self.last_checkpoint > self.checkpoint_every:
+            self.checkpoint()
+
+    def checkpoint(self) -> None:
+        self.last_checkpoint = time.monotonic()
+        if not self.on_checkpoint:
+            return
+        if self.pending:
+            self.on_checkpoint(self.pending[min(self.pending)], False)
+        elif self.last_fed:
+            self.on_checkpoint(self.last_fed, True)
+
+    def log_stats(self) -> None:
+        self.last_report = time.monotonic()
+        for id, stats in self.stats.items():
+            self.logger.info(f"worker {id}: {stats}")
@@ -0,0 +1,48 @@
+import fcntl
+import os
+import struct
+import time
+from typing import Callable
+
+# tokens, last refill time
+STATE = struct.Struct("=dd")
+
+class RateLimiter:
+    """
+    Token bucket shared by all the processes of a host through a small state file,
+    guarded by an exclusive lock. Times come from `clock`, in seconds since the epoch
+    as it is shared between processes, and waits go through `sleep`.
+    """
+
+    def __init__(self, path: str, rate: float, burst: float = 1, clock: Callable[[], float] = time.time, sleep: Callable[[float], None] = time.sleep) -> None:
+        self.path = path
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.sleep = sleep
+
+    def acquire(self) -> None:
+        """Blocks until a token is available, and takes it"""
+        while True:
+            wait = self._take()
+            if wait <= 0:
+                return
+            self.sleep(wait)
+
+    def _take(self) -> float:
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            data = os.pread(fd, STATE.size, 0)
+            now = self.clock()
+            tokens, last = STATE.unpack(data) if len(data) == STATE.size else (self.burst, now)
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0.0
+            else:
+                wait = (1 - tokens) / self.rate
+            os.pwrite(fd, STATE.pack(tokens, now), 0)
+            return wait
+        finally:
+            os.close(fd)
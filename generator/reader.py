@@ -0,0 +1,206 @@
+import bisect
+import io
+import zstandard
+import util
+from checkpoint import Checkpoint
+from model import RawGame
+from typing import BinaryIO, Iterable, Iterator, List, Optional, Tuple
+
+# bytes of decompressed PGN kept in the line buffer
+BUFFER_SIZE = 1 << 20
+# bytes of compressed input fed to the decompressor at once
+CHUNK_SIZE = 1 << 20
+# games extracted by extract.py, one per line
+SHARD_SUFFIXES = (".evals", ".evals.zst")
+# first line of a shard, changed with the format of its lines
+SHARD_MAGIC = b"#LPSHARD2\n"
+SITE_PREFIX = "https://lichess.org/"
+
+class ZstdFrameReader(io.RawIOBase):
+    """
+    Decompresses a zstd stream frame by frame, remembering where each frame
+    starts both in the compressed file and in the decompressed output,
+    so that a later run can seek straight to the frame holding a given offset.
+    """
+
+    def __init__(self, file: BinaryIO, compressed: int = 0, frame: int = 0) -> None:
+        file.seek(compressed)
+        self.file = file
+        self.compressed = compressed
+        # decompressed bytes produced so far, returned or not
+        self.produced = frame
+        # (decompressed offset, compressed offset) of each frame start seen
+        self.frames: List[Tuple[int, int]] = [(frame, compressed)]
+        self.dctx = zstandard.ZstdDecompressor()
+        self.dobj = self.dctx.decompressobj()
+        self.buffer = b""
+        self.cursor = 0
+        self.eof = False
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int: # type: ignore
+        while self.cursor == len(self.buffer) and not self.eof:
+            self._fill()
+        n = min(len(b), len(self.buffer) - self.cursor)
+        b[:n] = self.buffer[self.cursor:self.cursor + n]
+        self.cursor += n
+        return n
+
+    def frame_at(self, offset: int) -> Tuple[int, int]:
+        return self.frames[bisect.bisect_right(self.frames, (offset, float("inf"))) - 1]
+
+    def close(self) -> None:
+        self.file.close()
+        super().close()
+
+    def _fill(self) -> None:
+        chunk = self.file.read(CHUNK_SIZE)
+        if not chunk:
+            self.eof = True
+            return
+        out: List[bytes] = []
+        self.compressed += len(chunk)
+        while chunk:
+            out.append(self.dobj.decompress(chunk))
+            self.produced += len(out[-1])
+            if not self.dobj.eof:
+                break
+            chunk = self.dobj.unused_data
+            self.frames.append((self.produced, self.compressed - len(chunk)))
+            self.dobj = self.dctx.decompressobj()
+        self.buffer = b"".join(out)
+        self.cursor = 0
+
+class PgnSource:
+    """
+    A PGN file, or a shard written by extract.py, plain or zstd compressed,
+    optionally resumed from a checkpoint.
+    """
+
+    def __init__(self, file: str, checkpoint: Optional[Checkpoint] = None) -> None:
+        self.checkpoint = checkpoint
+        self.zstd: Optional[ZstdFrameReader] = None
+        if file.endswith(".zst"):
+            self.zstd = ZstdFrameReader(open(file, "rb"), checkpoint.compressed, checkpoint.frame) if checkpoint else ZstdFrameReader(open(file, "rb"))
+            self.stream: BinaryIO = io.BufferedReader(self.zstd, BUFFER_SIZE) # type: ignore
+            if checkpoint:
+                skip(self.stream, checkpoint.offset - checkpoint.frame)
+        else:
+            self.stream = open(file, "rb", buffering = BUFFER_SIZE)
+            if checkpoint:
+                self.stream.seek(checkpoint.offset)
+        self.read = read_shard if file.endswith(SHARD_SUFFIXES) else read_games
+
+    def games(self) -> Iterator[RawGame]:
+        if self.checkpoint:
+            return self.read(self.stream, self.checkpoint.offset, self.checkpoint.games)
+        return self.read(self.stream)
+
+    def checkpoint_at(self, raw: RawGame, version: int, after: bool = False) -> Checkpoint:
+        """Resumes from `raw`, or from the game following it if `after`"""
+        offset = raw.end if after else raw.offset
+        frame, compressed = self.zstd.frame_at(offset) if self.zstd else (0, 0)
+        return Checkpoint(version = version, games = raw.index - (not after), offset = offset, compressed = compressed, frame = frame)
+
+    def __enter__(self) -> "PgnSource":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.stream.close()
+
+def skip(stream: BinaryIO, size: int) -> None:
+    while size > 0:
+        read = len(stream.read(min(size, BUFFER_SIZE)))
+        if not read:
+            return
+        size -= read
+
+def parse_tag(line: bytes) -> Tuple[bytes, bytes]:
+    name, _, value = line[1:].partition(b" ")
+    return name, value.strip().rstrip(b"]").strip(b"\"")
+
+def parse_rating(value: bytes) -> int:
+    try:
+        return int(value)
+    except ValueError:
+        return 0
+
+def parse_time_control(value: bytes) -> Tuple[int, int]:
+    try:
+        seconds, increment = value.split(b"+")
+        return int(seconds), int(increment)
+    except ValueError:
+        return 0, 0
+
+def read_games(lines: Iterable[bytes], offset: int = 0, index: int = 0) -> Iterator[RawGame]:
+    """
+    Streams the games worth analysing out of raw PGN lines.
+    Only the header block of each game is looked at: once a game is known to be
+    a variant, or to land in tier 0, every following line up to the next game
+    is passed over without being parsed or decoded.
+    Games whose movetext has no `%eval` are dropped as well.
+    `offset` and `index` are where `lines` start in the source, when resuming.
+    """
+    start = offset
+    site: Optional[bytes] = None
+    tier = 0
+    has_master = False
+    elos = [0, 0]
+    time_control = (0, 0)
+    rejected = True
+    for line in lines:
+        if line.startswith(b"[Event "):
+            index += 1
+            start = offset
+            site = None
+            tier = 4
+            has_master = False
+            elos = [0, 0]
+            time_control = (0, 0)
+            rejected = False
+        elif rejected:
+            pass
+        elif line.startswith(b"["):
+            name, value = parse_tag(line)
+            if name == b"Site":
+                site = value
+            elif name == b"Variant":
+                rejected = value != b"Standard"
+            elif name == b"WhiteElo" or name == b"BlackElo":
+                elo = parse_rating(value)
+                elos[name == b"BlackElo"] = elo
+                tier = min(tier, util.rating_tier(elo))
+            elif name == b"TimeControl":
+                time_control = parse_time_control(value)
+                tier = min(tier, util.time_control_tier(*time_control))
+            elif name == b"WhiteTitle" or name == b"BlackTitle":
+                has_master = has_master or value != b"BOT"
+            rejected = rejected or tier == 0
+        elif not line.isspace():
+            # lichess dumps write the whole movetext on a single line
+            rejected = True
+            if site is not None and b"%eval" in line:
+                yield RawGame(index, start, site.decode(), tier, has_master, line, elos[0], elos[1], time_control, offset + len(line))
+        offset += len(line)
+
+def shard_line(raw: RawGame) -> bytes:
+    return b"%s %d %d %d %d %d+%d %s" % (raw.id.encode(), raw.tier, raw.has_master, raw.white_elo, raw.black_elo, *raw.time_control, raw.movetext)
+
+def read_shard(lines: Iterable[bytes], offset: int = 0, index: int = 0) -> Iterator[RawGame]:
+    """
+    Streams the games of a shard written by extract.py: a line per game,
+    with its id, tier, whether a titled player played it, the ratings
+    and the time control before the movetext.
+    """
+    for line in lines:
+        if offset == 0:
+            if line != SHARD_MAGIC:
+                raise ValueError("not a shard file, or of an unsupported version")
+            offset += len(line)
+            continue
+        index += 1
+        id, tier, has_master, white_elo, black_elo, time_control, movetext = line.split(b" ", 6)
+        yield RawGame(index, offset, SITE_PREFIX + id.decode(), int(tier), has_master == b"1", movetext, int(white_elo), int(black_elo), parse_time_control(time_control), offset + len(line))
+        offset += len(line)
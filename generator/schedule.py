@@ -0,0 +1,109 @@
+import heapq
+import chess
+import numpy as np
+import movetext
+import util
+from collections import deque
+from dataclasses import dataclass
+from model import RawGame
+from typing import Callable, Deque, Dict, Iterable, Iterator, List, Optional, Tuple
+
+@dataclass(frozen=True)
+class Features:
+    """What a game looks like before any search, from its header and evals"""
+    tier: int
+    # plies the evals make candidates, see `movetext.candidate_mask`
+    candidates: int
+    # largest win chances gained by a ply, from 0 to 2
+    swing: float
+    # pieces on the board at the first candidate, 0 without any
+    pieces: int
+
+def features(raw: RawGame, moves: movetext.Moves) -> Features:
+    tier = util.game_tier(raw.tier, raw.has_master, len(moves))
+    mask = movetext.candidate_mask(moves.evals, tier)
+    if not mask.any():
+        return Features(tier, 0, 0, 0)
+    # as in candidate_mask, seen from the side to move after each ply
+    side = np.where(np.arange(1, len(moves.evals) + 1) % 2 == 0, 1, -1)
+    chances = movetext.win_chances(moves.evals.astype(np.int32) * side)
+    prev = np.concatenate(([0], -chances[:-1]))
+    first = int(np.flatnonzero(mask)[0])
+    board = chess.Board(moves.fen)
+    for ply in range(first + 1):
+        board.push(moves.move(board, ply))
+    return Features(tier, int(mask.sum()), float(np.max(chances - prev)), chess.popcount(board.occupied))
+
+# of games whose moves can't be read, fed last so that their worker logs them
+LOWEST_PRIORITY = -1.0
+
+def priority(features: Features) -> float:
+    """
+    Higher for games more likely to give a puzzle. Games without candidates come last:
+    they cost no search, but never give anything. Then higher tiers, more candidates,
+    bigger swings, and positions far from tablebase endgames come first.
+    """
+    if not features.candidates:
+        return features.tier
+    return 10 + features.tier + min(features.candidates, 3) / 2 + features.swing + features.pieces / 32
+
+class Scheduler:
+    """
+    Reads up to `window` games ahead of the workers, and feeds them by decreasing `priority`
+    instead of source order. No game is held longer than `max_age` games read after it,
+    so that the oldest game held, from which a checkpoint must resume, keeps moving.
+    """
+
+    def __init__(self, window: int, moves_of: Callable[[RawGame], movetext.Moves] = lambda raw: movetext.parse(raw.movetext), max_age: Optional[int] = None) -> None:
+        self.window = window
+        self.moves_of = moves_of
+        self.max_age = max_age or window * 4
+        self.heap: List[Tuple[float, int, RawGame]] = []
+        # games held, by index, and their indices in source order
+        self.held: Dict[int, RawGame] = {}
+        self.order: Deque[int] = deque()
+
+    def __call__(self, games: Iterable[RawGame]) -> Iterator[RawGame]:
+        for raw in games:
+            heapq.heappush(self.heap, (-self._priority(raw), raw.index, raw))
+            self.held[raw.index] = raw
+            self.order.append(raw.index)
+            if self.oldest_index() < raw.index - self.max_age:
+                yield self._take(self.oldest_index())
+            elif len(self.held) > self.window:
+                yield self._pop()
+        while self.held:
+            yield self._pop()
+
+    def oldest(self) -> Optional[RawGame]:
+        return self.held[self.oldest_index()] if self.held else None
+
+    def resume(self, raw: RawGame, after: bool = False) -> Tuple[RawGame, bool]:
+        """
+        Where to resume from, and whether after it, given the oldest game fed and not processed yet,
+        or the last game fed and `after` once all of them were processed
+        """
+        oldest = self.oldest()
+        if oldest and (after or oldest.index < raw.index):
+            return oldest, False
+        return raw, after
+
+    def oldest_index(self) -> int:
+        while self.order[0] not in self.held:
+            self.order.popleft()
+        return self.order[0]
+
+    def _priority(self, raw: RawGame) -> float:
+        try:
+            return priority(features(raw, self.moves_of(raw)))
+        except Exception:
+            return LOWEST_PRIORITY
+
+    def _pop(self) -> RawGame:
+        # entries of games taken by age are left in the heap
+        while self.heap[0][1] not in self.held:
+            heapq.heappop(self.heap)
+        return self._take(heapq.heappop(self.heap)[1])
+
+    def _take(self, index: int) -> RawGame:
+        return self.held.pop(index)
@@ -0,0 +1,134 @@
+import argparse
+import hashlib
+import math
+import mmap
+import os
+import struct
+import time
+from array import array
+from typing import Iterable, NamedTuple, Set, Tuple
+
+MAGIC = b"LPSEEN01"
+# magic, bloom bits, bloom hashes, index slots
+HEADER = struct.Struct("=8sQQQ")
+
+def hash_key(key: str) -> Tuple[int, int]:
+    digest = hashlib.blake2b(key.encode(), digest_size = 16).digest()
+    h1, h2 = struct.unpack("=QQ", digest)
+    # 0 marks empty slots of the index
+    return h1 or 1, h2 | 1
+
+class Table(NamedTuple):
+    bits: int
+    hashes: int
+    slots: int
+    bloom: memoryview
+    # the open addressing table, named apart from `tuple.index`
+    keys: memoryview
+    # inode and modification time of the file it was mapped from
+    version: Tuple[int, int]
+
+class SeenStore:
+    """
+    Game ids and fen:uci position keys known to the validator, loaded from a file
+    built by `build`. A Bloom filter answers most negative lookups without
+    touching the index; an open addressing table of 64 bits key hashes
+    confirms probable hits. The file is memory mapped read only, so all the
+    processes of a host share the same pages.
+    Keys seen during this run are kept in memory on top of it.
+    The file is checked every `refresh_every` seconds, and mapped again once rebuilt.
+    """
+
+    def __init__(self, path: str, refresh_every: float = 600) -> None:
+        self.path = path
+        self.refresh_every = refresh_every
+        self.table = load(path)
+        self.next_refresh = time.monotonic() + refresh_every
+        self.recent: Set[str] = set()
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.recent or self.dumped(key)
+
+    def dumped(self, key: str) -> bool:
+        """Whether `key` is in the dump the file was built from"""
+        if time.monotonic() >= self.next_refresh:
+            self.refresh()
+        table = self.table
+        h1, h2 = hash_key(key)
+        for i in range(table.hashes):
+            bit = (h1 + i * h2) % table.bits
+            if not table.bloom[bit >> 3] & (1 << (bit & 7)):
+                return False
+        slot = h1 % table.slots
+        while table.keys[slot]:
+            if table.keys[slot] == h1:
+                return True
+            slot = (slot + 1) % table.slots
+        return False
+
+    def refresh(self) -> None:
+        self.next_refresh = time.monotonic() + self.refresh_every
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return
+        if (stat.st_ino, stat.st_mtime_ns) != self.table.version:
+            self.table = load(self.path)
+
+    def add(self, key: str) -> None:
+        self.recent.add(key)
+
+def load(path: str) -> Table:
+    with open(path, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        stat = os.fstat(f.fileno())
+    magic, bits, hashes, slots = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not a seen store")
+    bloom_end = HEADER.size + bits // 8
+    bloom = memoryview(data)[HEADER.size:bloom_end]
+    index = memoryview(data)[bloom_end:bloom_end + slots * 8].cast("Q")
+    return Table(bits, hashes, slots, bloom, index, (stat.st_ino, stat.st_mtime_ns))
+
+def build(path: str, keys: Iterable[str], fp_rate: float = 0.01) -> int:
+    hashed = array("Q", (h for key in keys for h in hash_key(key)))
+    n = len(hashed) // 2
+    bits = max(64, math.ceil(-n * math.log(fp_rate) / math.log(2) ** 2 / 64) * 64)
+    hashes = max(1, round(bits / max(n, 1) * math.log(2)))
+    slots = max(1, n * 2)
+    bloom = bytearray(bits // 8)
+    index = array("Q", bytes(slots * 8))
+    for i in range(n):
+        h1, h2 = hashed[2 * i], hashed[2 * i + 1]
+        for j in range(hashes):
+            bit = (h1 + j * h2) % bits
+            bloom[bit >> 3] |= 1 << (bit & 7)
+        slot = h1 % slots
+        while index[slot] and index[slot] != h1:
+            slot = (slot + 1) % slots
+        index[slot] = h1
+    # moved in place, so that running generators keep reading the previous file until they refresh
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(HEADER.pack(MAGIC, bits, hashes, slots))
+        f.write(bloom)
+        f.write(index.tobytes())
+    os.replace(tmp, path)
+    return n
+
+def read_keys(files: Iterable[str]) -> Iterable[str]:
+    for file in files:
+        with open(file) as f:
+            for line in f:
+                key = line.strip()
+                if key:
+                    yield key
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog='seen.py',
+        description='builds the local seen store from dumps of known game ids and fen:uci puzzle keys, see bin/dump-seen.js')
+    parser.add_argument("dumps", nargs="+", help="files with one key per line", metavar="DUMP.txt")
+    parser.add_argument("--output", "-o", help="store file to write", default="seen.store")
+    args = parser.parse_args()
+    print(f"{build(args.output, read_keys(args.dumps))} keys written to {args.output}")
@@ -1,6 +1,9 @@
 import logging
 from chess.pgn import Game, GameNode, ChildNode
 from model import Puzzle
+from seen import SeenStore
+from spool import Spool
+from typing import Any, Dict, List, Optional, Set
 import requests
 import urllib.parse
 from requests.adapters import HTTPAdapter
@@ -17,43 +20,108 @@ http = requests.Session()
 http.mount("https://", adapter)
 http.mount("http://", adapter)
 
+# the spool retries on its own, without holding up the analysis
+spool_adapter = HTTPAdapter(max_retries=Retry(total=2, backoff_factor=0.5, allowed_methods=frozenset(['POST'])))
+spool_http = requests.Session()
+spool_http.mount("https://", spool_adapter)
+spool_http.mount("http://", spool_adapter)
+
+# seen lookups and marks give up quickly, the store answering when the server can't
+seen_adapter = HTTPAdapter(max_retries=Retry(total=2, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=frozenset(['GET', 'POST'])))
+seen_http = requests.Session()
+seen_http.mount("https://", seen_adapter)
+seen_http.mount("http://", seen_adapter)
+
 TIMEOUT = 4
 
+def position_key(node: ChildNode) -> str:
+    return f"{node.parent.board().fen()}:{node.uci()}"
+
 class Server:
 
-    def __init__(self, logger: logging.Logger, url: str, token: str, version: int) -> None:
+    def __init__(self, logger: logging.Logger, url: str, token: str, version: int, store: Optional[SeenStore] = None, spool_dir: Optional[str] = None) -> None:
         self.logger = logger
         self.url = url
         self.token = token
         self.version = version
+        # when set, answers the lookups of the keys it doesn't hold without asking the server,
+        # which only confirms the probable hits of its dump
+        self.store = store
+        # when set, puzzles are posted in the background
+        self.spool = Spool(logger, spool_dir, self._post_batch) if spool_dir and url else None
 
     def is_seen(self, id: str) -> bool:
-        if not self.url:
-            return False
-        try:
-            status = http.get(self._seen_url(id), timeout = TIMEOUT).status_code
-            return status == 200
-        except Exception as e:
-            self.logger.error(e)
-            return False
+        return self._is_seen(id, id)
 
     def set_seen(self, game: Game) -> None:
+        if self.store:
+            self.store.add(game.headers.get("Site", "?")[20:])
         try:
             if self.url:
-                http.post(self._seen_url(game.headers.get("Site", "?")[20:]), timeout = TIMEOUT)
+                seen_http.post(self._seen_url(game.headers.get("Site", "?")[20:]), timeout = TIMEOUT)
         except Exception as e:
             self.logger.error(e)
 
+    def are_seen(self, ids: List[str]) -> Set[str]:
+        """
+        Which of `ids`, game ids or position keys, were already seen, in a single request
+        about the probable hits of the store, or about all of them without a store
+        """
+        if self.store is None:
+            return self._ask_batch(ids) or set()
+        recent = {id for id in ids if id in self.store.recent}
+        dumped = [id for id in ids if id not in recent and self.store.dumped(id)]
+        seen = self._ask_batch(dumped) if dumped else None
+        if seen is None:
+            # the store is trusted when the server can't tell
+            return recent | set(dumped)
+        for id in seen:
+            self.store.add(id)
+        return recent | seen
+
     def is_seen_pos(self, node: ChildNode) -> bool:
-        if not self.url:
+        key = position_key(node)
+        return self._is_seen(key, urllib.parse.quote(key))
+
+    def are_seen_pos(self, nodes: List[ChildNode]) -> Set[str]:
+        return self.are_seen([position_key(node) for node in nodes])
+
+    def _is_seen(self, key: str, id: str) -> bool:
+        if self.store is None:
+            return bool(self._ask_seen(id))
+        if key in self.store.recent:
+            return True
+        if not self.store.dumped(key):
             return False
-        id = urllib.parse.quote(f"{node.parent.board().fen()}:{node.uci()}")
+        seen = self._ask_seen(id)
+        if seen is None:
+            return True
+        if seen:
+            self.store.add(key)
+        return seen
+
+    def _ask_seen(self, id: str) -> Optional[bool]:
+        """Whether the server saw `id`, None when it can't tell"""
+        if not self.url:
+            return None
         try:
-            status = http.get(self._seen_url(id), timeout = TIMEOUT).status_code
+            status = seen_http.get(self._seen_url(id), timeout = TIMEOUT).status_code
             return status == 200
         except Exception as e:
             self.logger.error(e)
-            return False
+            return None
+
+    def _ask_batch(self, ids: List[str]) -> Optional[Set[str]]:
+        """Which of `ids` the server saw, None when it can't tell"""
+        if not self.url or not ids:
+            return None
+        try:
+            r = seen_http.post("{}/seen/batch?token={}".format(self.url, self.token), json={'ids': ids}, timeout = TIMEOUT)
+            r.raise_for_status()
+            return set(r.json()["seen"])
+        except Exception as e:
+            self.logger.error(e)
+            return None
 
     def _seen_url(self, id: str) -> str:
         return "{}/seen?token={}&id={}".format(self.url, self.token, id)
@@ -61,6 +129,8 @@ class Server:
     def post(self, game_id: str, puzzle: Puzzle) -> None:
         parent = puzzle.node.parent
         assert parent
+        if self.store:
+            self.store.add(position_key(puzzle.node))
         json = {
             'game_id': game_id,
             'fen': parent.board().fen(),
@@ -72,8 +142,24 @@ class Server:
         if not self.url:
             print(json)
             return None
+        if self.spool:
+            self.spool.append(json)
+            return None
         try:
             r = http.post("{}/puzzle?token={}".format(self.url, self.token), json=json, timeout = TIMEOUT)
             self.logger.info(r.text if r.ok else "FAILURE {}".format(r.text))
         except Exception as e:
             self.logger.error("Couldn't post puzzle: {}".format(e))
+
+    def _post_batch(self, puzzles: List[Dict[str, Any]]) -> bool:
+        r = spool_http.post("{}/puzzle/batch?token={}".format(self.url, self.token), json={'puzzles': puzzles}, timeout = TIMEOUT)
+        if not r.ok:
+            self.logger.error("FAILURE {}".format(r.text))
+            return False
+        for message in r.json()["messages"]:
+            self.logger.info(message)
+        return True
+
+    def close(self) -> None:
+        if self.spool:
+            self.spool.close()
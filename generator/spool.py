@@ -0,0 +1,168 @@
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, IO, List
+
+Puzzle = Dict[str, Any]
+
+class CircuitBreaker:
+    """
+    Stops calling a failing service for a while after `threshold` consecutive failures,
+    waiting twice longer after each failed retry, up to `max_cooldown` seconds.
+    """
+
+    def __init__(self, threshold: int = 3, cooldown: float = 5, max_cooldown: float = 300) -> None:
+        self.threshold = threshold
+        self.min_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.cooldown = cooldown
+        self.failures = 0
+        self.open_until = 0.0
+
+    def allows(self) -> bool:
+        return time.monotonic() >= self.open_until
+
+    def success(self) -> None:
+        self.failures = 0
+        self.cooldown = self.min_cooldown
+
+    def failure(self) -> None:
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self.open_until = time.monotonic() + self.cooldown
+            self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+
+class Spool:
+    """
+    Puzzles waiting to be posted, appended to a file in `dir` before a background
+    thread sends them by batches, so that posting never blocks the analysis and
+    no puzzle is lost if the validator is down or the process dies.
+    Each process owns a file, locked while it runs; files left by dead processes
+    are taken over and their unsent puzzles sent again.
+    `send` returns whether a batch was accepted.
+    """
+
+    def __init__(self, logger: logging.Logger, dir: str, send: Callable[[List[Puzzle]], bool], batch_size: int = 50) -> None:
+        self.logger = logger
+        self.send = send
+        self.batch_size = batch_size
+        self.breaker = CircuitBreaker()
+        os.makedirs(dir, exist_ok = True)
+        self.path = os.path.join(dir, f"{os.getpid()}.jsonl")
+        # only moved in place once locked, so that no other process takes it over
+        tmp = f"{self.path}.tmp"
+        self.file: IO[str] = open(tmp, "w+")
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+        self.seq = 0
+        self.unsent: Dict[int, Puzzle] = {}
+        self.cond = threading.Condition()
+        self.closing = False
+        self.deadline = 0.0
+        # left by a previous process with the same pid
+        self._take_over(self.path)
+        os.replace(tmp, self.path)
+        for name in os.listdir(dir):
+            path = os.path.join(dir, name)
+            if path != self.path and name.endswith(".jsonl"):
+                self._take_over(path)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def append(self, puzzle: Puzzle) -> None:
+        with self.cond:
+            self.seq += 1
+            self._write({"seq": self.seq, "puzzle": puzzle})
+            self.unsent[self.seq] = puzzle
+            self.cond.notify()
+
+    def close(self, timeout: float = 10) -> None:
+        """Sends what can be sent within `timeout` seconds; the rest stays in the file for next run."""
+        with self.cond:
+            self.closing = True
+            self.deadline = time.monotonic() + timeout
+            self.cond.notify()
+        self.thread.join(timeout)
+        with self.cond:
+            if not self.unsent:
+                os.remove(self.path)
+            self.file.close()
+
+    def _take_over(self, path: str) -> None:
+        try:
+            f = open(path)
+        except FileNotFoundError:
+            # taken over by another process
+            return
+        with f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # owned by a running process
+                return
+            if os.fstat(f.fileno()).st_nlink == 0:
+                # taken over by another process while this one waited for the lock
+                return
+            puzzles = read_unsent(f)
+            for puzzle in puzzles:
+                self.append(puzzle)
+            # still locked, so that no other process reads it again
+            os.remove(path)
+        if puzzles:
+            self.logger.info(f"Resending {len(puzzles)} puzzles from {path}")
+
+    def _write(self, record: Dict[str, Any]) -> None:
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+
+    def _run(self) -> None:
+        while True:
+            with self.cond:
+                while not self.unsent and not self.closing:
+                    self.cond.wait()
+                if not self.unsent:
+                    return
+                batch = dict(list(self.unsent.items())[:self.batch_size])
+            if not self.breaker.allows():
+                if self.closing and time.monotonic() > self.deadline:
+                    return
+                time.sleep(1)
+                continue
+            try:
+                sent = self.send(list(batch.values()))
+            except Exception as e:
+                self.logger.error(f"Couldn't post puzzles: {e}")
+                sent = False
+            if not sent:
+                self.breaker.failure()
+                if self.closing and time.monotonic() > self.deadline:
+                    return
+                time.sleep(1)
+                continue
+            self.breaker.success()
+            with self.cond:
+                if self.file.closed:
+                    return
+                for seq in batch:
+                    del self.unsent[seq]
+                    self._write({"ack": seq})
+                if not self.unsent:
+                    # everything was sent, start over with an empty file
+                    self.file.seek(0)
+                    self.file.truncate()
+
+def read_unsent(f: IO[str]) -> List[Puzzle]:
+    puzzles: Dict[int, Puzzle] = {}
+    for line in f:
+        try:
+            record = json.loads(line)
+        except ValueError:
+            # torn last line
+            continue
+        if "ack" in record:
+            puzzles.pop(record["ack"], None)
+        else:
+            puzzles[record["seq"]] = record["puzzle"]
+    return list(puzzles.values())
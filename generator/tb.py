@@ -1,8 +1,9 @@
-import datetime
 import logging
-import time
+import os
+import tempfile
 
 import chess
+import chess.syzygy
 import requests
 
 from typing import Optional, Literal, Dict, Any
@@ -12,7 +13,9 @@ from chess.pgn import GameNode
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
 
+from cache import TablebaseCache
 from model import NextMovePair, TbPair, EngineMove
+from ratelimit import RateLimiter
 
 TB_API = "http://tablebase.lichess.ovh/standard?fen={}"
 
@@ -27,25 +30,70 @@ RETRY_STRAT = Retry(
 )
 ADAPTER = HTTPAdapter(max_retries=RETRY_STRAT)
 
+# best first, from the point of view of the side making the move
+MOVE_ORDER: Dict[WDL, int] = { "loss": 0, "blessed-loss": 1, "maybe-loss": 1, "draw": 2, "unknown": 2, "cursed-win": 3, "maybe-win": 3, "win": 4 }
+
+
+# at most one request every 550ms from the whole host
+TB_RATE_LIMITER = RateLimiter(os.path.join(tempfile.gettempdir(), "lichess-puzzler-tablebase.ratelimit"), rate = 1 / 0.55)
+
 class TbChecker:
 
-    def __init__(self, log: logging.Logger) -> None:
+    def __init__(self, log: logging.Logger, syzygy: Optional[str] = None, cache: Optional[TablebaseCache] = None) -> None:
+        """
+        `syzygy`: directory of local tables, probed before the HTTP API
+        `cache`: API responses, shared by all checkers of the host
+        """
         self.session = requests.Session()
         self.session.mount("http://", ADAPTER)
         self.session.mount("https://", ADAPTER)
         self.log = log
-        self.last_req: Optional[datetime.datetime] = None
-
-    def _probe(self, fen: str) -> Dict[str, Any]:
-        if self.last_req is not None:
-            wait = (self.last_req + datetime.timedelta(milliseconds=550) - datetime.datetime.now()).total_seconds()
-            if wait > 0:
-                time.sleep(wait)
-        resp = self.session.get(TB_API.format(fen),timeout=5).json()
-        # conservative to take last_req after the end of the request
-        self.last_req = datetime.datetime.now()
+        self.tablebase = chess.syzygy.open_tablebase(syzygy) if syzygy else None
+        self.cache = cache
+
+    def _probe(self, board: chess.Board) -> Dict[str, Any]:
+        # the categories depend on the halfmove clock, which EPD leaves out
+        epd = f"{board.epd()} {board.halfmove_clock}"
+        resp = self.cache.get(epd) if self.cache else None
+        if resp is None:
+            TB_RATE_LIMITER.acquire()
+            resp = self.session.get(TB_API.format(board.fen()),timeout=5).json()
+            # only what `get_only_winning_move` looks at
+            resp = {
+                "category": resp["category"],
+                "moves": [{"uci": move["uci"], "category": move["category"]} for move in resp.get("moves", [])],
+            }
+            if self.cache:
+                self.cache.put(epd, resp)
         return resp
 
+    def _probe_syzygy(self, board: chess.Board) -> Dict[str, Any]:
+        """
+        Probes the local tables, answering in the shape of the HTTP API.
+        Raises `chess.syzygy.MissingTableError` if a table is missing.
+        """
+        assert self.tablebase
+        moves = []
+        for move in board.legal_moves:
+            board.push(move)
+            mate = board.is_checkmate()
+            if mate:
+                category: WDL = "loss"
+                dtz = 0
+            elif board.is_stalemate():
+                category = "draw"
+                dtz = 0
+            else:
+                dtz = self.tablebase.get_dtz(board) or 0
+                category = syzygy_category(self.tablebase.probe_wdl(board), dtz, board.halfmove_clock)
+            board.pop()
+            moves.append((MOVE_ORDER[category], not mate, -dtz, move.uci(), category))
+        moves.sort()
+        return {
+            "category": syzygy_category(self.tablebase.probe_wdl(board), self.tablebase.get_dtz(board) or 0, board.halfmove_clock),
+            "moves": [{"uci": uci, "category": category} for _, _, _, uci, category in moves],
+        }
+
     # `*` is used to force kwarg only for `looking_for_mate`
     def get_only_winning_move(self, node: GameNode, winner: Color, *,looking_for_mate: bool) -> Optional[TbPair]:
         """
@@ -63,11 +111,19 @@ class TbChecker:
         if len(chess.SquareSet(board.occupied)) > 7 or board.turn != winner:
             return None
         fen = board.fen()
-        try:
-            rep = self._probe(fen)
-        except requests.exceptions.RequestException as e:
-            self.log.warning(f"req error while checking tb for fen {fen}: {e}")
-            return None
+        rep: Optional[Dict[str, Any]] = None
+        if self.tablebase:
+            try:
+                rep = self._probe_syzygy(board)
+            # missing table, or castling rights
+            except KeyError as e:
+                self.log.debug(f"falling back to the tb API for fen {fen}: {e}")
+        if rep is None:
+            try:
+                rep = self._probe(board)
+            except requests.exceptions.RequestException as e:
+                self.log.warning(f"req error while checking tb for fen {fen}: {e}")
+                return None
         # The API return results in descending order (best move firsts)
         # So only checking for the first two moves should be enough to know 
         # if there are more than one winning move.
@@ -86,6 +142,23 @@ class TbChecker:
         self.log.debug(f"tb check for {fen}, best move: {best}, second move: {second}, only winning move: {only_winning_move}")
         return TbPair(node=node, winner=winner, best=best, second=second,only_winning_move=only_winning_move)
 
+def syzygy_category(wdl: int, dtz: int, halfmoves: int) -> WDL:
+    """
+    The category the API gives a position of `wdl` and `dtz`, for the side to move,
+    once `halfmoves` plies were played since the last capture or pawn move.
+    A win or loss with no time left to zero the clock before the 50 moves rule is cursed or blessed,
+    and it may be either when DTZ, which some tables round by one, falls at the limit.
+    """
+    if wdl == 0:
+        return "draw"
+    win = wdl > 0
+    plies = abs(dtz) + halfmoves
+    if abs(wdl) == 1 or plies > 101:
+        return "cursed-win" if win else "blessed-loss"
+    if halfmoves and plies > 98:
+        return "maybe-win" if win else "maybe-loss"
+    return "win" if win else "loss"
+
 def to_engine_move(move: Dict[str, Any], *,turn: Color, winner: Color) -> EngineMove:
     pov_score = chess.engine.PovScore(relative=wdl_to_cp(move["category"]),turn=turn)
     return EngineMove(chess.Move.from_uci(move["uci"]), pov_score.pov(winner))
@@ -1,19 +1,45 @@
 import unittest
+import unittest.mock
+import fcntl
+import io
 import logging
+import os
+import tempfile
+import threading
+import time
 import zlib
+import zstandard
+from concurrent.futures import ThreadPoolExecutor
 import chess
-from model import Puzzle, NextMovePair, EngineMove, TbPair
+import chess.pgn
+import chess.syzygy
+from model import Puzzle, NextMovePair, EngineMove, TbPair, RawGame
 from pathlib import Path
 from generator import logger
-from server import Server
+from server import Server, seen_http
 from tb import TbChecker, TB_API
-from chess.engine import SimpleEngine, Mate, Cp, Score, PovScore, InfoDict
+from chess.engine import SimpleEngine, Mate, Cp, Score, PovScore, InfoDict, PlayResult
 from chess import Move, Color, Board, WHITE, BLACK
-from chess.pgn import Game, GameNode
+from chess.pgn import Game, GameNode, ChildNode
 from vcr.unittest import VCRTestCase # type: ignore
-from typing import List, Optional, Tuple, Literal, Union
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple, Literal, Union
 
-from generator import Generator, Server, make_engine
+from generator import Counters, Generator, SearchConfig, Server, make_engine, pair_limit, advantage_defense_limit
+from reader import PgnSource, read_games
+from extract import ShardWriter, extract
+from gamebin import GameFile, GameFileSource, build as build_game_file
+from frames import FramedSource, INDEX_SUFFIX, load_index, reframe
+from schedule import Scheduler, features, priority
+from orchestrator import Orchestrator
+from cache import AnalysisCache, CachingEngine, TablebaseCache
+from ratelimit import RateLimiter
+from seen import SeenStore, build as build_seen_store
+from spool import CircuitBreaker, Spool, read_unsent
+from mate import MateProver
+from engines import Analysis
+from budget import Budget, BudgetedEngine, BudgetExceeded, Cancelled, GameBudget
+import movetext
+import numpy as np
 
 class CachedEngine(SimpleEngine):
 
@@ -53,7 +79,7 @@ class TestGenerator(VCRTestCase):
         cls.engine = CachedEngine.popen_uci("stockfish")
         cls.engine.configure({'Threads': 6}) # don't use more than 6 threads! it fails at finding mates
         cls.server = Server(logger, "", "", 0)
-        cls.gen = Generator(cls.engine, cls.server)
+        cls.gen = Generator(cls.engine, cls.server, config = SearchConfig.reference())
         logger.setLevel(logging.DEBUG)
 
     def test_puzzle_1(self) -> None:
@@ -270,5 +296,984 @@ class TestTbChecker(VCRTestCase):
         self.assertEqual(tb_pair, expected)
 
 
+def pgn_lines(headers: str, movetext: str) -> List[bytes]:
+    return [f"{line}\n".encode() for line in headers.strip().splitlines()] + [b"\n", f"{movetext}\n".encode(), b"\n"]
+
+class FakeTablebase(chess.syzygy.Tablebase):
+    """Every position is a draw, except the ones listed, in which the side to move loses"""
+
+    def __init__(self, root: Board, losing: List[str]) -> None:
+        super().__init__()
+        self.root = root.board_fen()
+        self.losing = losing
+
+    def probe_wdl(self, board: Board) -> int:
+        return 2 if board.board_fen() == self.root else -2 if board.board_fen() in self.losing else 0
+
+    def get_dtz(self, board: Board, default: Optional[int] = None) -> Optional[int]:
+        return 10 if board.board_fen() == self.root else -10 if board.board_fen() in self.losing else 0
+
+class TestSyzygy(unittest.TestCase):
+
+    def test_correct_best_move(self) -> None:
+        checker = TbChecker(logger)
+        fen = "5K2/8/7p/6P1/1p5P/k7/8/8 w - - 0 49"
+        board = Board(fen)
+        board.push_uci("g5h6")
+        checker.tablebase = FakeTablebase(Board(fen), [board.board_fen()])
+        node = chess.pgn.Game.from_board(Board(fen=fen))
+        tb_pair = checker.get_only_winning_move(node, WHITE, looking_for_mate=False)
+        assert isinstance(tb_pair, TbPair)
+        self.assertEqual(tb_pair.best, EngineMove(Move.from_uci("g5h6"), Cp(999999998)))
+        self.assertEqual(tb_pair.second and tb_pair.second.score, Cp(0))
+        self.assertTrue(tb_pair.only_winning_move)
+
+    def test_multiple_winning_moves(self) -> None:
+        checker = TbChecker(logger)
+        fen = "4k3/8/8/8/8/8/3PPPPP/4K3 w - - 0 1"
+        board = Board(fen)
+        losing = []
+        for move in board.legal_moves:
+            board.push(move)
+            losing.append(board.board_fen())
+            board.pop()
+        checker.tablebase = FakeTablebase(board, losing)
+        node = chess.pgn.Game.from_board(Board(fen=fen))
+        tb_pair = checker.get_only_winning_move(node, WHITE, looking_for_mate=False)
+        assert isinstance(tb_pair, TbPair)
+        self.assertFalse(tb_pair.only_winning_move)
+
+    def test_fifty_moves_rule(self) -> None:
+        checker = TbChecker(logger)
+        for clock, only_winning_move in [(0, True), (95, False)]:
+            fen = f"5K2/8/7p/6P1/1p5P/k7/8/8 w - - {clock} 120"
+            board = Board(fen)
+            board.push_uci("f8g7")
+            checker.tablebase = FakeTablebase(Board(fen), [board.board_fen()])
+            node = chess.pgn.Game.from_board(Board(fen))
+            tb_pair = checker.get_only_winning_move(node, WHITE, looking_for_mate=False)
+            assert isinstance(tb_pair, TbPair)
+            self.assertEqual(tb_pair.best, EngineMove(Move.from_uci("f8g7"), Cp(999999998) if only_winning_move else Cp(0)))
+            self.assertEqual(tb_pair.only_winning_move, only_winning_move)
+
+class TestReader(unittest.TestCase):
+
+    headers = """
+[Event "Rated Blitz game"]
+[Site "https://lichess.org/abcdefgh"]
+[WhiteElo "1800"]
+[BlackElo "1650"]
+[Variant "Standard"]
+[TimeControl "600+0"]
+"""
+    movetext = "1. e4 { [%eval 0.24] } 1... e5 { [%eval 0.2] } 1-0"
+
+    def test_real_game(self) -> None:
+        with open("test_pgn_3fold_uDMCM.pgn", "rb") as pgn:
+            games = list(read_games(pgn))
+        self.assertEqual(len(games), 1)
+        self.assertEqual(games[0].id, "ZlCTzfMG")
+        self.assertEqual(games[0].index, 1)
+        self.assertEqual(games[0].tier, 2)
+        self.assertTrue(games[0].has_master)
+
+    def test_tier(self) -> None:
+        games = list(read_games(pgn_lines(self.headers, self.movetext)))
+        self.assertEqual([(g.id, g.tier, g.has_master) for g in games], [("abcdefgh", 2, False)])
+
+    def test_rejected(self) -> None:
+        variant = self.headers.replace("Standard", "Atomic")
+        low_rated = self.headers.replace("1650", "1400")
+        bullet = self.headers.replace("600+0", "60+0")
+        bot = self.headers + '[WhiteTitle "BOT"]\n'
+        lines = (
+            pgn_lines(variant, self.movetext) +
+            pgn_lines(low_rated, self.movetext) +
+            pgn_lines(bullet, self.movetext) +
+            pgn_lines(self.headers, "1. e4 e5 1-0") +
+            pgn_lines(bot, self.movetext)
+        )
+        games = list(read_games(lines))
+        self.assertEqual([(g.index, g.has_master) for g in games], [(5, False)])
+
+    def test_resume_from_checkpoint(self) -> None:
+        games = [b"".join(pgn_lines(self.headers.replace("abcdefgh", f"game{i:04}"), self.movetext)) for i in range(300)]
+        for suffix in [".pgn", ".pgn.zst"]:
+            with tempfile.NamedTemporaryFile(suffix = suffix) as f:
+                if suffix == ".pgn":
+                    f.write(b"".join(games))
+                else:
+                    # several frames, with boundaries falling in the middle of games
+                    data = b"".join(games)
+                    for start in range(0, len(data), 10_000):
+                        f.write(zstandard.ZstdCompressor().compress(data[start:start + 10_000]))
+                f.flush()
+                with PgnSource(f.name) as source:
+                    read = list(source.games())
+                    checkpoint = source.checkpoint_at(read[200], version = 1)
+                    after = source.checkpoint_at(read[200], version = 1, after = True)
+                self.assertEqual(len(read), 300)
+                self.assertEqual(checkpoint.games, 200)
+                self.assertEqual(checkpoint.compressed > 0, suffix == ".pgn.zst")
+                with PgnSource(f.name, checkpoint) as source:
+                    resumed = list(source.games())
+                self.assertEqual(resumed, read[200:])
+                with PgnSource(f.name, after) as source:
+                    self.assertEqual(list(source.games()), read[201:])
+
+    def test_framed_source(self) -> None:
+        lines = [line for i in range(300) for line in pgn_lines(self.headers.replace("abcdefgh", f"game{i:04}"), self.movetext)]
+        with tempfile.TemporaryDirectory() as dir:
+            path = os.path.join(dir, "framed.pgn.zst")
+            frames = reframe(lines, path, frame_size = 5000)
+            self.assertEqual(load_index(path + INDEX_SUFFIX), frames)
+            self.assertGreater(len(frames), 10)
+            self.assertEqual(frames[-1].games, 300)
+            with open(path, "rb") as f:
+                data = f.read()
+            for frame, next in zip(frames, frames[1:]):
+                self.assertTrue(zstandard.ZstdDecompressor().decompress(data[frame.compressed:next.compressed]).startswith(b"[Event "))
+            with PgnSource(path) as source:
+                read = list(source.games())
+            with FramedSource(path, frames, 3) as framed:
+                self.assertEqual(list(framed.games()), read)
+                checkpoint = framed.checkpoint_at(read[200], version = 1)
+                after = framed.checkpoint_at(read[199], version = 1, after = True)
+            sources: List[Union[FramedSource, PgnSource]] = [FramedSource(path, frames, 2, checkpoint), PgnSource(path, checkpoint), FramedSource(path, frames, 2, after)]
+            for resumed in sources:
+                with resumed:
+                    self.assertEqual(list(resumed.games()), read[200:])
+
+    def test_extract_shards(self) -> None:
+        lines = [line for i in range(100) for line in pgn_lines(self.headers.replace("abcdefgh", f"game{i:04}").replace("1650", str(1550 + i)), self.movetext)]
+        games = list(read_games(lines))
+        with tempfile.TemporaryDirectory() as dir:
+            counts = extract(games, ShardWriter(dir, "dump", shards = 2))
+            self.assertEqual(counts, {1: 51, 2: 49})
+            paths = sorted(os.listdir(dir))
+            self.assertEqual(paths, [f"dump-tier{t}-{s:02}.evals.zst" for t in [1, 2] for s in [0, 1]])
+            extracted = []
+            for path in paths:
+                with PgnSource(os.path.join(dir, path)) as source:
+                    read = list(source.games())
+                    checkpoint = source.checkpoint_at(read[len(read) // 2], version = 1)
+                    after = source.checkpoint_at(read[len(read) // 2 - 1], version = 1, after = True)
+                for resumed in [checkpoint, after]:
+                    with PgnSource(os.path.join(dir, path), resumed) as source:
+                        self.assertEqual(list(source.games()), read[len(read) // 2:])
+                extracted.extend(read)
+        key = lambda g: (g.id, g.tier, g.has_master, g.movetext)
+        self.assertEqual(sorted(map(key, extracted)), sorted(map(key, games)))
+
+    def test_old_shard(self) -> None:
+        with tempfile.NamedTemporaryFile(suffix = ".evals") as f:
+            f.write(b"abcdefgh 3 0 " + self.movetext.encode() + b"\n")
+            f.flush()
+            with PgnSource(f.name) as source:
+                with self.assertRaises(ValueError):
+                    list(source.games())
+
+    def test_extract_interrupted(self) -> None:
+        def interrupted() -> Iterator[RawGame]:
+            yield from read_games(pgn_lines(self.headers, self.movetext))
+            raise KeyboardInterrupt
+        with tempfile.TemporaryDirectory() as dir:
+            with self.assertRaises(KeyboardInterrupt):
+                extract(interrupted(), ShardWriter(dir, "dump"))
+            self.assertEqual(os.listdir(dir), [])
+
+
+class EvenWorker:
+
+    def process(self, raw: RawGame) -> bool:
+        return raw.index % 2 == 0
+
+    def knps(self) -> int:
+        return 0
+
+    def counters(self) -> Dict[str, int]:
+        return {"games": 1}
+
+    def close(self) -> None:
+        pass
+
+class TestOrchestrator(unittest.TestCase):
+
+    def test_all_games_processed(self) -> None:
+        orchestrator = Orchestrator(logger, workers=3, queue_size=2)
+        games = (RawGame(i, 0, f"https://lichess.org/{i:08}", 3, False, b"") for i in range(1, 21))
+        orchestrator.run(games, EvenWorker)
+        self.assertEqual(sum(s.games for s in orchestrator.stats.values()), 20)
+        self.assertEqual(sum(s.puzzles for s in orchestrator.stats.values()), 10)
+
+    def test_checkpoint_after_last_game(self) -> None:
+        orchestrator = Orchestrator(logger, workers=2, queue_size=2)
+        games = (RawGame(i, 0, f"https://lichess.org/{i:08}", 3, False, b"") for i in range(1, 11))
+        checkpoints: List[Tuple[int, bool]] = []
+        orchestrator.run(games, EvenWorker, lambda raw, after: checkpoints.append((raw.index, after)))
+        self.assertEqual(checkpoints[-1], (10, True))
+
+
+class FakeEngine:
+    """The `Engine` protocol, whose calls fakes implement as their tests need"""
+
+    def analyse(self, board: Board, limit: chess.engine.Limit, *, multipv: Optional[int] = None, **kwargs: Any) -> Any:
+        raise NotImplementedError
+
+    def analysis(self, board: Board, limit: chess.engine.Limit, *, multipv: Optional[int] = None, **kwargs: Any) -> Analysis:
+        raise NotImplementedError
+
+    def play(self, board: Board, limit: chess.engine.Limit, **kwargs: Any) -> PlayResult:
+        raise NotImplementedError
+
+class CountingEngine(FakeEngine):
+
+    def __init__(self) -> None:
+        self.calls = 0
+
+    def analyse(self, board: Board, limit: chess.engine.Limit, *, multipv: Optional[int] = None, **kwargs: Any) -> List[InfoDict]:
+        self.calls += 1
+        move = next(iter(board.legal_moves))
+        return [{"score": PovScore(Mate(-3), board.turn), "pv": [move], "depth": 20, "nodes": 1000, "nps": 5000}]
+
+class ScriptedEngine(FakeEngine):
+    """Answers multipv searches with the given scores for the side to move, by limit"""
+
+    def __init__(self, scores: Dict[str, List[Score]]) -> None:
+        self.scores = scores
+        self.limits: List[str] = []
+
+    def analyse(self, board: Board, limit: chess.engine.Limit, *, multipv: Optional[int] = None, **kwargs: Any) -> List[InfoDict]:
+        self.limits.append(str(limit))
+        moves = list(board.legal_moves)
+        return [{"score": PovScore(score, board.turn), "pv": [moves[i]], "nps": 1000} for i, score in enumerate(self.scores[str(limit)][:multipv])]
+
+class TestSearchCascade(unittest.TestCase):
+
+    def pair(self, shallow: List[Score], deep: List[Score], winner: Color = BLACK, predicted: Optional[Move] = None) -> Tuple[Optional[NextMovePair], Generator]:
+        config = SearchConfig(early_stop_depths = 0)
+        engine = ScriptedEngine({str(config.shallow_limit): shallow, str(pair_limit): deep, str(advantage_defense_limit): deep, str(config.confirm_limit): shallow})
+        gen = Generator(engine, Server(logger, "", "", 0), config = config)
+        game = Game()
+        node = game.add_main_variation(Move.from_uci("e2e4"))
+        return gen.get_next_pair(node, winner, looking_for_mate = False, predicted = predicted), gen
+
+    def test_shallow_reject(self) -> None:
+        pair, gen = self.pair([Cp(500), Cp(420)], [Cp(500), Cp(-200)])
+        self.assertIsNone(pair)
+        self.assertEqual(gen.stats, {"shallow": 1, "deep avoided": 1})
+
+    def test_ambiguous(self) -> None:
+        pair, gen = self.pair([Cp(500), Cp(50)], [Cp(500), Cp(-200)])
+        assert pair and pair.second
+        self.assertEqual(pair.second.score, Cp(-200))
+        self.assertEqual(gen.stats, {"shallow": 1, "deep": 1})
+
+    def test_mate_goes_deep(self) -> None:
+        pair, gen = self.pair([Mate(3), Cp(-300)], [Mate(3), Cp(-300)])
+        self.assertIsNotNone(pair)
+        self.assertEqual(gen.stats["deep"], 1)
+
+    def test_mate_search(self) -> None:
+        class MateEngine(FakeEngine):
+            def __init__(self, mate: Score, other: Score) -> None:
+                self.mate = mate
+                self.other = other
+                self.limits: List[str] = []
+            def analyse(self, board: Board, limit: chess.engine.Limit, *, multipv: Optional[int] = None, root_moves: Optional[List[Move]] = None, **kwargs: Any) -> Any:
+                self.limits.append(str(limit))
+                if root_moves:
+                    return {"score": PovScore(self.other, board.turn), "pv": [root_moves[0]]}
+                score = self.mate if limit.mate else Cp(-100)
+                return [{"score": PovScore(score, board.turn), "pv": [next(iter(board.legal_moves))]}] * (multipv or 1)
+        limit = chess.engine.Limit(mate = 6, depth = 80, time = 15, nodes = 12_000_000)
+        node = Game().add_main_variation(Move.from_uci("e2e4"))
+        for other, unique in [(Cp(-100), True), (Mate(6), False)]:
+            engine = MateEngine(Mate(5), other)
+            gen = Generator(engine, Server(logger, "", "", 0))
+            pair = gen.get_next_pair(node, BLACK, looking_for_mate = True, mate_in = 6)
+            self.assertEqual(pair is not None, unique)
+            # the other moves are searched with the usual limit
+            self.assertEqual(engine.limits, [str(limit), str(pair_limit)])
+        # a mate announced by the eval but not found falls back to the usual searches
+        engine = MateEngine(Cp(300), Cp(-100))
+        gen = Generator(engine, Server(logger, "", "", 0), config = SearchConfig(shallow_limit = None, early_stop_depths = 0))
+        gen.get_next_pair(node, BLACK, looking_for_mate = True, mate_in = 6)
+        self.assertEqual(engine.limits, [str(limit), str(pair_limit)])
+        self.assertEqual(gen.stats["mate not confirmed"], 1)
+
+    def test_defense_single_line(self) -> None:
+        pair, gen = self.pair([], [Cp(-500), Cp(-900)], winner = WHITE)
+        assert pair
+        self.assertIsNone(pair.second)
+        assert isinstance(gen.engine.engine, ScriptedEngine)
+        self.assertEqual(gen.engine.engine.limits, [str(advantage_defense_limit)])
+        self.assertEqual(gen.stats, {"defense": 1})
+
+    def test_confirmed_prediction(self) -> None:
+        first = next(iter(Board("rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq - 0 1").legal_moves))
+        pair, gen = self.pair([Cp(-400)], [Cp(-500)], winner = WHITE, predicted = first)
+        assert pair
+        self.assertEqual((pair.best.move, pair.best.score), (first, Cp(400)))
+        self.assertEqual(gen.stats, {"confirm": 1})
+        pair, gen = self.pair([Cp(-400)], [Cp(-500)], winner = WHITE, predicted = Move.from_uci("e7e5"))
+        assert pair
+        self.assertEqual(pair.best.score, Cp(500))
+        self.assertEqual(gen.stats, {"confirm": 1, "prediction broken": 1, "defense": 1})
+
+class StreamingEngine(FakeEngine):
+    """Streams multipv 2 searches, one pair of scores for the side to move per depth"""
+
+    def __init__(self, depths: Sequence[Tuple[Score, Score]]) -> None:
+        self.depths = depths
+        self.searched = 0
+        self.board = Board()
+        self.multipv: List[InfoDict] = []
+
+    def analysis(self, board: Board, limit: chess.engine.Limit, *, multipv: Optional[int] = None, **kwargs: Any) -> "StreamingEngine":
+        self.board = board
+        self.multipv = []
+        return self
+
+    def __enter__(self) -> "StreamingEngine":
+        return self
+
+    def __exit__(self, *args) -> None:
+        pass
+
+    def __iter__(self) -> Iterator[InfoDict]:
+        moves = list(self.board.legal_moves)
+        for depth, scores in enumerate(self.depths, 1):
+            self.searched = depth
+            self.multipv = [{"score": PovScore(score, self.board.turn), "pv": [moves[i]], "depth": depth, "multipv": i + 1} for i, score in enumerate(scores)]
+            yield from self.multipv
+
+    def stop(self) -> None:
+        pass
+
+class TestEarlyStop(unittest.TestCase):
+
+    def search(self, depths: Sequence[Tuple[Score, Score]], looking_for_mate: bool = False) -> Tuple[Optional[NextMovePair], Generator, StreamingEngine]:
+        engine = StreamingEngine(depths)
+        gen = Generator(engine, Server(logger, "", "", 0), config = SearchConfig(shallow_limit = None, early_stop_depths = 3, early_stop_min_depth = 5))
+        node = Game().add_main_variation(Move.from_uci("e2e4"))
+        return gen.get_next_pair(node, BLACK, looking_for_mate), gen, engine
+
+    def test_stops_once_rejection_is_stable(self) -> None:
+        pair, gen, engine = self.search([(Cp(500), Cp(-300))] * 5 + [(Cp(500), Cp(400))] * 20)
+        self.assertIsNone(pair)
+        self.assertEqual(engine.searched, 8)
+        self.assertEqual(gen.stats["deep stopped early"], 1)
+
+    def test_not_winning(self) -> None:
+        depths = [(Cp(150), Cp(-300))] * 20
+        self.assertEqual(self.search(depths)[2].searched, 7)
+        self.assertEqual(self.search(depths, looking_for_mate = True)[2].searched, 20)
+
+    def test_unique_completes(self) -> None:
+        pair, gen, engine = self.search([(Cp(500), Cp(400))] * 6 + [(Cp(500), Cp(-300))] * 20)
+        assert pair and pair.second
+        self.assertEqual(engine.searched, 26)
+        self.assertEqual(pair.second.score, Cp(-300))
+
+class TestMateProver(unittest.TestCase):
+
+    def board(self, fen: str, moves: str) -> Board:
+        board = Board(fen)
+        for uci in moves.split():
+            board.push_uci(uci)
+        return board
+
+    def node(self, fen: str, moves: str) -> ChildNode:
+        node = Game.from_board(self.board(fen, moves)).end()
+        assert isinstance(node, ChildNode)
+        return node
+
+    def test_mate_in_one(self) -> None:
+        board = self.board("6k1/5ppp/8/8/8/8/8/R5K1 w - - 0 1", "")
+        self.assertEqual(MateProver().mating_moves(board, 3), [(Move.from_uci("a1a8"), 1)])
+
+    def test_mate_in_three(self) -> None:
+        # same as test_puzzle_3
+        board = self.board("1r4k1/5p1p/pr1p2p1/q2Bb3/2P5/P1R3PP/KB1R1Q2/8 b - - 1 31", "e5c3")
+        prover = MateProver()
+        self.assertEqual(prover.mating_moves(board, 3), [(Move.from_uci("f2f7"), 3)])
+        board.push_uci("f2f7")
+        self.assertEqual(prover.longest_defence(board, 2), (Move.from_uci("g8h8"), 2))
+        self.assertIsNone(prover.longest_defence(board, 1))
+
+    def test_cook_mate(self) -> None:
+        class NonMatingEngine(FakeEngine):
+            def analyse(self, board: Board, limit: chess.engine.Limit, *, multipv: Optional[int] = None, root_moves: Optional[List[Move]] = None, **kwargs: Any) -> InfoDict:
+                assert root_moves
+                return {"score": PovScore(Cp(-300), board.turn), "pv": [root_moves[0]]}
+
+        gen = Generator(NonMatingEngine(), Server(logger, "", "", 0))
+        node = self.node("1r4k1/5p1p/pr1p2p1/q2Bb3/2P5/P1R3PP/KB1R1Q2/8 b - - 1 31", "e5c3")
+        solution = gen.cook_mate(node, WHITE, mate_in = 3)
+        self.assertEqual(" ".join(move.uci() for move in solution or []), "f2f7 g8h8 f7f6 c3f6 b2f6")
+        self.assertEqual(gen.stats["prover mates"], 3)
+
+    def test_short_mate_unwanted(self) -> None:
+        # same as test_puzzle_1, a mate in two
+        node = self.node("3q1k2/p7/1p2Q2p/5P1K/1P4P1/P7/8/8 w - - 5 57", "h5g6")
+        engine = ExcludingEngine(Cp(-500))
+        gen = Generator(engine, Server(logger, "", "", 0))
+        self.assertIsNone(gen.cook_mate(node, BLACK, mate_in = 3, unwanted = Mate(2)))
+        self.assertEqual(len(engine.root_moves), 1)
+        self.assertEqual(len(gen.cook_mate(node, BLACK, mate_in = 3) or []), 3)
+
+    def test_several_mates_in_one(self) -> None:
+        # mates in two and three are left to the engine, only the mates in one are excluded
+        node = self.node("8/8/8/8/1Q6/8/8/k1K5 b - - 0 1", "a1a2")
+        for score, valid in [(Cp(300), True), (Cp(900), False)]:
+            engine = ExcludingEngine(score)
+            gen = Generator(engine, Server(logger, "", "", 0))
+            self.assertEqual(gen.get_next_pair(node, WHITE, looking_for_mate = True, mate_in = 1) is not None, valid)
+            self.assertEqual(len(engine.root_moves[0]), len(list(node.board().legal_moves)) - 2)
+
+    def test_out_of_nodes(self) -> None:
+        board = self.board("1r4k1/5p1p/pr1p2p1/q2Bb3/2P5/P1R3PP/KB1R1Q2/8 b - - 1 31", "e5c3")
+        self.assertIsNone(MateProver(max_nodes = 100).mating_moves(board, 3))
+
+class ExcludingEngine(FakeEngine):
+
+    def __init__(self, score: Score) -> None:
+        self.score = score
+        self.root_moves: List[List[Move]] = []
+
+    def analyse(self, board: Board, limit: chess.engine.Limit, *, multipv: Optional[int] = None, root_moves: Optional[List[Move]] = None, **kwargs: Any) -> InfoDict:
+        assert root_moves
+        self.root_moves.append(root_moves)
+        return {"score": PovScore(self.score, board.turn), "pv": [root_moves[0]]}
+
+class TestRestrictedSearch(unittest.TestCase):
+
+    def test_several_mates_in_one(self) -> None:
+        node = Game.from_board(Board("6k1/5ppp/8/8/8/8/8/R2R2K1 w - - 0 1"))
+        pair = NextMovePair(node, WHITE, EngineMove(Move.from_uci("a1a8"), Mate(1)), EngineMove(Move.from_uci("d1d8"), Mate(1)))
+        for score, valid in [(Cp(300), True), (Cp(900), False)]:
+            engine = ExcludingEngine(score)
+            gen = Generator(engine, Server(logger, "", "", 0))
+            self.assertEqual(gen.is_valid_mate_in_one(pair), valid)
+            self.assertEqual(len(engine.root_moves[0]), len(list(node.board().legal_moves)) - 2)
+            self.assertNotIn(Move.from_uci("a1a8"), engine.root_moves[0])
+
+class TestBudget(unittest.TestCase):
+
+    def test_budget(self) -> None:
+        counting = CountingEngine()
+        gen = Generator(counting, Server(logger, "", "", 0))
+        self.assertEqual(gen.budget(1).limits, GameBudget(seconds = 120, nodes = 500_000_000))
+        self.assertEqual(gen.budget(7).limits, GameBudget(seconds = 300, nodes = 1_250_000_000))
+        self.assertIsNone(Generator(CountingEngine(), Server(logger, "", "", 0), config = SearchConfig.reference()).budget(3).limits)
+        gen.engine.budget = Budget(GameBudget(seconds = 60, nodes = 2500))
+        board = Board()
+        gen.engine.analyse(board, chess.engine.Limit(depth = 20), multipv = 2)
+        gen.engine.analyse(board, chess.engine.Limit(depth = 20), multipv = 2)
+        gen.engine.analyse(board, chess.engine.Limit(depth = 20), multipv = 2)
+        with self.assertRaises(BudgetExceeded):
+            gen.engine.analyse(board, chess.engine.Limit(depth = 20), multipv = 2)
+        self.assertEqual(counting.calls, 3)
+
+    def test_slow_game(self) -> None:
+        gen = Generator(CountingEngine(), Server(logger, "", "", 0), config = SearchConfig(budgets = {1: GameBudget(seconds = 0, nodes = 0)}))
+        game = chess.pgn.read_game(io.StringIO("1. e4 { [%eval 0.3] } e5 { [%eval 0.3] } 2. Qh5 { [%eval 0.0] } Nc6 { [%eval 0.3] } 3. Bc4 { [%eval 0.1] } Nf6 { [%eval 5.0] } 4. Qxf7# *"))
+        assert game
+        # the eval jump after Nf6 calls for a search, which the empty budget refuses
+        self.assertIsNone(gen.analyze_game(game, 1))
+        self.assertEqual(gen.stats["games over budget"], 1)
+        self.assertIsNone(gen.engine.budget)
+
+class SlowGenerator(Generator):
+    """Probes the first plies longest, finding puzzles on `plies`"""
+
+    plies = {3, 5}
+    running = 0
+
+    def probe(self, node: ChildNode, score: Score, tier: int) -> Optional[Puzzle]:
+        self.stats.add("probes")
+        with self.stats.lock:
+            self.running += 1
+        try:
+            for _ in range(10 - node.ply()):
+                time.sleep(0.01)
+                self.engine.analyse(node.board(), chess.engine.Limit(depth = 1))
+            return Puzzle(node, [], 0) if node.ply() in self.plies else None
+        finally:
+            with self.stats.lock:
+                self.running -= 1
+
+class TestParallelProbes(unittest.TestCase):
+
+    def test_first_in_game_order(self) -> None:
+        game = chess.pgn.read_game(io.StringIO("1. e4 e5 2. Nf3 Nc6 3. Bb5 a6 4. Ba4 Nf6 *"))
+        assert game
+        candidates: List[Tuple[ChildNode, Score]] = [(node, Cp(500)) for node in game.mainline()]
+        for probes in [1, 4]:
+            gen = SlowGenerator(CountingEngine(), Server(logger, "", "", 0), config = SearchConfig(probes = probes))
+            puzzle = gen.probe_first(candidates, 3)
+            assert puzzle
+            self.assertEqual(puzzle.node.ply(), 3)
+            # cancelled probes are done with their engine
+            self.assertEqual(gen.running, 0)
+
+    def test_shared_executor(self) -> None:
+        game = chess.pgn.read_game(io.StringIO("1. e4 e5 2. Nf3 Nc6 *"))
+        assert game
+        candidates: List[Tuple[ChildNode, Score]] = [(node, Cp(500)) for node in game.mainline()]
+        with ThreadPoolExecutor(4) as executor:
+            stats = Counters()
+            gens = [SlowGenerator(CountingEngine(), Server(logger, "", "", 0), config = SearchConfig(probes = 4), stats = stats, executor = executor) for _ in range(2)]
+            found: List[Optional[Puzzle]] = []
+            threads = [threading.Thread(target = lambda gen: found.append(gen.probe_first(candidates, 3)), args = (gen,)) for gen in gens]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertTrue(all(gen.executor is executor for gen in gens))
+            self.assertEqual([puzzle.node.ply() if puzzle else None for puzzle in found], [3, 3])
+
+    def test_cancelled_probe(self) -> None:
+        gen = Generator(CountingEngine(), Server(logger, "", "", 0))
+        budget = Budget(None).probe()
+        budget.cancel()
+        with self.assertRaises(Cancelled):
+            budget.probe().check()
+        node = Game().add_main_variation(Move.from_uci("e2e4"))
+        self.assertIsNone(gen.probe_within(budget, node, Cp(500), 3))
+        self.assertEqual(gen.stats["probes cancelled"], 1)
+
+class TestMovetext(unittest.TestCase):
+
+    scholar = b"1. e4 { [%eval 0.3] } 1... e5 $2 { [%eval 0.2] } ( 1... c5 { [%eval 0.3] } 2. Nf3 ) 2. Qh5 { [%eval -1.0] } 2... Nc6 { [%eval 0.1] } 3. Bc4 { [%eval 0.0] } 3... Nf6?? { [%eval #1] } 4. Qxf7# 1-0"
+
+    def test_parse(self) -> None:
+        with open("test_pgn_3fold_uDMCM.pgn") as f:
+            game = chess.pgn.read_game(f)
+        assert game
+        with open("test_pgn_3fold_uDMCM.pgn", "rb") as b:
+            moves = movetext.parse(b.read().split(b"\n\n", 1)[1])
+        expected = movetext.of_game(game)
+        self.assertEqual(moves.sans, expected.sans)
+        self.assertEqual(list(moves.evals), list(expected.evals))
+        self.assertEqual(moves.sans, [node.san() for node in game.mainline()])
+
+    def test_variations_and_missing_evals(self) -> None:
+        moves = movetext.parse(self.scholar)
+        self.assertEqual(moves.sans, ["e4", "e5", "Qh5", "Nc6", "Bc4", "Nf6", "Qxf7#"])
+        self.assertEqual(list(moves.evals), [30, 20, -100, 10, 0, 31999])
+        self.assertEqual(movetext.decode(moves.evals[5]).white(), Mate(1))
+        self.assertEqual(movetext.decode(movetext.encode(b"#-3")).black(), Mate(3))
+
+    def test_candidate_mask(self) -> None:
+        moves = movetext.parse(self.scholar)
+        self.assertEqual(list(movetext.candidate_mask(moves.evals, 2)), [False] * 6)
+        self.assertEqual(list(movetext.candidate_mask(moves.evals, 3)), [False] * 5 + [True])
+
+    def test_repetition_past_evals(self) -> None:
+        gen = Generator(CountingEngine(), Server(logger, "", "", 0))
+        sans = "Nf3 Nf6 Ng1 Ng8 Nf3 Nf6 Ng1 Ng8 Nc3 Nc6 e4".split()
+        moves = movetext.Moves(sans, np.array([20, 20, 20, 20, 20, 500], dtype = np.int16))
+        self.assertEqual(gen.candidates("", moves, 3), [])
+
+    def test_candidate_mask_covers_candidates(self) -> None:
+        gen = Generator(CountingEngine(), Server(logger, "", "", 0))
+        with open("test_pgn_3fold_uDMCM.pgn") as f:
+            game = chess.pgn.read_game(f)
+        assert game
+        moves = movetext.of_game(game)
+        for tier in [1, 2, 3]:
+            mask = movetext.candidate_mask(moves.evals, tier)
+            prev_score: Score = Cp(20)
+            for ply, node in enumerate(list(game.mainline())[:len(moves.evals)]):
+                score = movetext.decode(int(moves.evals[ply])).pov(node.turn())
+                if gen.is_candidate(node, prev_score, score, tier):
+                    self.assertTrue(mask[ply])
+                prev_score = -score
+
+class TestGameFile(unittest.TestCase):
+
+    def test_table_batches(self) -> None:
+        with open("test_pgn_3fold_uDMCM.pgn", "rb") as pgn:
+            game = next(read_games(pgn))
+        games = [RawGame(i, 0, f"https://lichess.org/game{i:04}", 3, False, game.movetext) for i in range(1, 6)]
+        with tempfile.TemporaryDirectory() as dir, unittest.mock.patch("gamebin.TABLE_BATCH", 2):
+            path = os.path.join(dir, "test.games")
+            self.assertEqual(build_game_file(path, games), 5)
+            file = GameFile(path)
+            self.assertEqual([file.raw(i).id for i in range(len(file))], [raw.id for raw in games])
+            self.assertEqual(list(file.moves(4).evals), list(movetext.parse(game.movetext).evals))
+
+    def test_round_trip(self) -> None:
+        with open("test_pgn_3fold_uDMCM.pgn", "rb") as pgn:
+            games = list(read_games(pgn))
+        promotion = RawGame(1, 0, "https://lichess.org/promotio", 3, False, b"1. h4 { [%eval 0.1] } 1... g5 2. hxg5 h6 3. gxh6 Nc6 4. h7 Nb4 5. hxg8=N *", 2000, 1900, (600, 5))
+        illegal = RawGame(1, 0, "https://lichess.org/illegal0", 3, False, b"1. e5 *")
+        with tempfile.TemporaryDirectory() as dir:
+            path = os.path.join(dir, "test.games")
+            self.assertEqual(build_game_file(path, games + [illegal, promotion]), 2)
+            file = GameFile(path)
+            self.assertEqual(len(file), 2)
+            raw = file.raw(0)
+            self.assertEqual((raw.id, raw.tier, raw.has_master, raw.white_elo, raw.black_elo, raw.time_control), ("ZlCTzfMG", 2, True, 2370, 2441, (300, 0)))
+            self.assertEqual(file.raw(1).time_control, (600, 5))
+            for i, raw in enumerate([games[0], promotion]):
+                expected = movetext.parse(raw.movetext)
+                moves = file.moves(i)
+                board = chess.Board()
+                for ply in range(len(moves)):
+                    self.assertEqual(board.san(moves.move(board, ply)), expected.sans[ply])
+                    board.push(moves.move(board, ply))
+                self.assertEqual(list(moves.evals), list(expected.evals))
+            self.assertEqual(moves.move(chess.Board(), 8).promotion, chess.KNIGHT)
+            with GameFileSource(path) as source:
+                read = list(source.games())
+                checkpoint = source.checkpoint_at(read[1], version = 1)
+                after = source.checkpoint_at(read[0], version = 1, after = True)
+            for resumed in [checkpoint, after]:
+                with GameFileSource(path, resumed) as source:
+                    self.assertEqual(list(source.games()), read[1:])
+
+    def test_same_candidates(self) -> None:
+        gen = Generator(CountingEngine(), Server(logger, "", "", 0))
+        with open("test_pgn_3fold_uDMCM.pgn", "rb") as pgn:
+            games = list(read_games(pgn))
+        with tempfile.TemporaryDirectory() as dir:
+            path = os.path.join(dir, "test.games")
+            build_game_file(path, games)
+            moves = GameFile(path).moves(0)
+            for tier in [1, 2, 3]:
+                from_file = gen.candidates("", moves, tier)
+                from_pgn = gen.candidates("", movetext.parse(games[0].movetext), tier)
+                self.assertEqual([(n.board().fen(), s) for n, s in from_file], [(n.board().fen(), s) for n, s in from_pgn])
+
+class TestScheduler(unittest.TestCase):
+
+    quiet = b"1. e4 { [%eval 0.3] } 1... e5 { [%eval 0.2] } 2. Nf3 { [%eval 0.2] } *"
+    blunder = b"1. e4 { [%eval 0.3] } 1... e5 { [%eval 0.2] } 2. Nf3 { [%eval 0.2] } 2... Qh4?? { [%eval 4.5] } *"
+
+    def game(self, index: int, movetext: bytes, tier: int = 3) -> RawGame:
+        return RawGame(index, index, f"https://lichess.org/game{index:04}", tier, False, movetext)
+
+    def test_features(self) -> None:
+        quiet = features(self.game(1, self.quiet), movetext.parse(self.quiet))
+        self.assertEqual((quiet.candidates, quiet.pieces), (0, 0))
+        blunder = features(self.game(2, self.blunder), movetext.parse(self.blunder))
+        self.assertEqual((blunder.tier, blunder.candidates, blunder.pieces), (5, 1, 32))
+        self.assertGreater(blunder.swing, 0.6)
+        self.assertGreater(priority(blunder), priority(quiet))
+        self.assertGreater(priority(features(self.game(3, self.quiet, 3), movetext.parse(self.quiet))), priority(features(self.game(4, self.quiet, 1), movetext.parse(self.quiet))))
+
+    def test_order(self) -> None:
+        games = [self.game(i, self.blunder if i % 5 == 0 else self.quiet) for i in range(1, 41)]
+        scheduler = Scheduler(10, max_age = 1000)
+        fed = list(scheduler(games))
+        self.assertEqual(sorted(raw.index for raw in fed), list(range(1, 41)))
+        # a game is fed per game read once the window is full, the best held first
+        self.assertEqual([fed.index(raw) for raw in games[4::5]], [0, 1, 4, 9, 14, 19, 24, 29])
+        self.assertIsNone(scheduler.oldest())
+
+    def test_max_age(self) -> None:
+        games = [self.game(i, self.quiet if i == 1 else self.blunder) for i in range(1, 41)]
+        scheduler = Scheduler(10, max_age = 15)
+        fed = []
+        for raw in scheduler(games):
+            fed.append(raw.index)
+            oldest = scheduler.oldest()
+            if oldest and 1 not in fed:
+                self.assertEqual(oldest.index, 1)
+                self.assertEqual(scheduler.resume(raw)[0].index, 1)
+        # held until 15 more games were read
+        self.assertEqual(fed.index(1), 17 - 11)
+
+    def test_illegal_move(self) -> None:
+        illegal = b"1. e4 { [%eval 0.3] } 1... e5 { [%eval 0.2] } 2. Nf3 { [%eval 0.2] } 2... Qh5?? { [%eval 4.5] } *"
+        games = [self.game(1, illegal, 5), self.game(2, self.quiet, 0), self.game(3, self.blunder)]
+        fed = list(Scheduler(10)(games))
+        self.assertEqual([raw.index for raw in fed], [3, 2, 1])
+
+class TestAnalysisCache(unittest.TestCase):
+
+    def test_cache(self) -> None:
+        limit = chess.engine.Limit(depth = 20)
+        with tempfile.TemporaryDirectory() as dir:
+            path = f"{dir}/cache.sqlite"
+            counting = CountingEngine()
+            engine = CachingEngine(counting, AnalysisCache(path, 100))
+            board = Board()
+            lines = lambda infos: [(info["score"], info["pv"]) for info in infos]
+            first = engine.analyse(board, limit, multipv = 2)
+            self.assertEqual(lines(engine.analyse(board, limit, multipv = 2)), lines(first))
+            self.assertEqual(counting.calls, 1)
+            engine.analyse(board, chess.engine.Limit(depth = 21), multipv = 2)
+            engine.analyse(board, limit, multipv = 1)
+            self.assertEqual(counting.calls, 3)
+            # shared through the file
+            other = CachingEngine(counting, AnalysisCache(path, 100))
+            self.assertEqual(lines(other.analyse(board, limit, multipv = 2)), lines(first))
+            self.assertEqual(counting.calls, 3)
+
+    def test_hits_not_charged(self) -> None:
+        limit = chess.engine.Limit(depth = 20)
+        with tempfile.TemporaryDirectory() as dir:
+            engine = BudgetedEngine(CachingEngine(CountingEngine(), AnalysisCache(f"{dir}/cache.sqlite", 100)))
+            engine.budget = Budget(GameBudget(60, 1500))
+            for _ in range(3):
+                engine.analyse(Board(), limit, multipv = 2)
+            self.assertEqual(engine.budget.nodes, 1000)
+            self.assertNotIn("nps", engine.analyse(Board(), limit, multipv = 2)[0])
+
+    def test_history(self) -> None:
+        limit = chess.engine.Limit(depth = 20)
+        with tempfile.TemporaryDirectory() as dir:
+            counting = CountingEngine()
+            engine = CachingEngine(counting, AnalysisCache(f"{dir}/cache.sqlite", 100))
+            board = Board()
+            engine.analyse(board, limit)
+            # same position, after knights moved out and back
+            for uci in ["g1f3", "g8f6", "f3g1", "f6g8"]:
+                board.push_uci(uci)
+            engine.analyse(board, limit)
+            engine.analyse(board, limit)
+            self.assertEqual(counting.calls, 3)
+            # same position and halfmove clock, without repetition
+            board = Board()
+            board.halfmove_clock = 4
+            engine.analyse(board, limit)
+            engine.analyse(board, limit)
+            self.assertEqual(counting.calls, 4)
+
+    def test_touch_batch(self) -> None:
+        limit = chess.engine.Limit(depth = 20)
+        with tempfile.TemporaryDirectory() as dir:
+            cache = AnalysisCache(f"{dir}/cache.sqlite", 100, touch_batch = 2)
+            engine = CachingEngine(CountingEngine(), cache)
+            used = lambda: cache._db().execute("SELECT MIN(used) FROM analysis").fetchone()[0]
+            boards = [Board(), Board("4k3/8/8/8/8/8/8/4K2R w K - 0 1")]
+            for board in boards:
+                engine.analyse(board, limit)
+            put = used()
+            engine.analyse(boards[0], limit)
+            engine.analyse(boards[0], limit)
+            self.assertEqual(used(), put)
+            self.assertEqual(len(cache.touched), 1)
+            engine.analyse(boards[1], limit)
+            self.assertGreater(used(), put)
+            self.assertEqual(cache.touched, {})
+
+    def test_eviction(self) -> None:
+        limit = chess.engine.Limit(depth = 20)
+        with tempfile.TemporaryDirectory() as dir:
+            engine = CachingEngine(CountingEngine(), AnalysisCache(f"{dir}/cache.sqlite", 10))
+            board = Board()
+            for move in list(board.legal_moves):
+                board.push(move)
+                engine.analyse(board, limit, multipv = 2)
+                board.pop()
+            engine.cache.evict()
+            count = engine.cache._db().execute("SELECT COUNT(*) FROM analysis").fetchone()[0]
+            self.assertEqual(count, 10)
+
+    def test_analysis(self) -> None:
+        limit = chess.engine.Limit(depth = 20)
+        with tempfile.TemporaryDirectory() as dir:
+            streaming = StreamingEngine([(Cp(100), Cp(50))] * 3)
+            engine = CachingEngine(streaming, AnalysisCache(f"{dir}/cache.sqlite", 100))
+            board = Board()
+            with engine.analysis(board, limit, multipv = 2) as analysis:
+                for info in analysis:
+                    analysis.stop()
+                    break
+            self.assertIsNone(engine.cache.get(board, 2, str(limit)))
+            with engine.analysis(board, limit, multipv = 2) as analysis:
+                list(analysis)
+            self.assertEqual(engine.analyse(board, limit, multipv = 2)[1]["score"], PovScore(Cp(50), WHITE))
+
+class TestTablebaseCache(unittest.TestCase):
+
+    def test_cache(self) -> None:
+        response = {"category": "win", "moves": [{"uci": "g5h6", "category": "loss"}]}
+        with tempfile.TemporaryDirectory() as dir:
+            cache = TablebaseCache(f"{dir}/cache.sqlite", memory_entries = 1)
+            epd = Board("5K2/8/7p/6P1/1p5P/k7/8/8 w - - 0 49").epd()
+            self.assertIsNone(cache.get(epd))
+            cache.put(epd, response)
+            cache.put(Board().epd(), {"category": "draw", "moves": []})
+            self.assertEqual(len(cache.memory), 1)
+            self.assertEqual(cache.get(epd), response)
+            self.assertEqual(TablebaseCache(f"{dir}/cache.sqlite").get(epd), response)
+
+    def test_keyed_by_halfmove_clock(self) -> None:
+        response = unittest.mock.Mock()
+        response.json.return_value = {"category": "win", "moves": []}
+        with tempfile.TemporaryDirectory() as dir:
+            checker = TbChecker(logger, cache = TablebaseCache(f"{dir}/cache.sqlite"))
+            with unittest.mock.patch.object(checker.session, "get", return_value = response) as get, unittest.mock.patch("tb.TB_RATE_LIMITER"):
+                for clock in [0, 0, 90]:
+                    checker._probe(Board(f"5K2/8/7p/6P1/1p5P/k7/8/8 w - - {clock} 49"))
+            self.assertEqual(get.call_count, 2)
+
+class FakeClock:
+
+    def __init__(self) -> None:
+        self.now = 1_000_000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.now += seconds
+
+class TestRateLimiter(unittest.TestCase):
+
+    def test_shared_bucket(self) -> None:
+        clock = FakeClock()
+        with tempfile.TemporaryDirectory() as dir:
+            limiters = [RateLimiter(f"{dir}/limiter", rate = 50, clock = clock, sleep = clock.sleep) for _ in range(2)]
+            for i in range(10):
+                limiters[i % 2].acquire()
+        # the first token is there from the start, the others come every 1/50s
+        self.assertAlmostEqual(clock.now - 1_000_000, 9 / 50)
+
+class TestSeenStore(unittest.TestCase):
+
+    def test_store(self) -> None:
+        games = [f"game{i:04}" for i in range(2000)]
+        positions = [f"{Board().fen()}:{move.uci()}" for move in Board().legal_moves]
+        with tempfile.TemporaryDirectory() as dir:
+            path = f"{dir}/seen.store"
+            self.assertEqual(build_seen_store(path, games + positions), 2020)
+            store = SeenStore(path)
+        self.assertTrue(all(key in store for key in games + positions))
+        unknown = [f"other{i:04}" for i in range(2000)]
+        self.assertLess(sum(key in store for key in unknown), 10)
+        store.add("other0000")
+        self.assertTrue("other0000" in store)
+
+    def test_hits_confirmed_by_server(self) -> None:
+        with tempfile.TemporaryDirectory() as dir:
+            path = f"{dir}/seen.store"
+            build_seen_store(path, ["dumped00", "dumped01"])
+            server = Server(logger, "http://validator", "", 0, SeenStore(path))
+        asked: List[List[str]] = []
+        def post(url: str, json: Dict[str, List[str]], timeout: float) -> Any:
+            asked.append(json["ids"])
+            response = unittest.mock.Mock()
+            response.json.return_value = {"seen": ["dumped00"]}
+            return response
+        with unittest.mock.patch("server.seen_http.post", post):
+            self.assertEqual(server.are_seen(["dumped00", "dumped01", "unseen00"]), {"dumped00"})
+            self.assertEqual(asked, [["dumped00", "dumped01"]])
+            # confirmed by the server, now known to the store
+            self.assertEqual(server.are_seen(["dumped00", "unseen00"]), {"dumped00"})
+            self.assertEqual(len(asked), 1)
+        with unittest.mock.patch("server.seen_http.post", side_effect = ConnectionError("down")):
+            self.assertEqual(server.are_seen(["dumped01", "unseen00"]), {"dumped01"})
+
+    def test_server_down(self) -> None:
+        # the validator being down doesn't hold the seen lookups and marks for long
+        self.assertLessEqual(seen_http.get_adapter("http://validator").max_retries.total, 2)
+        with tempfile.TemporaryDirectory() as dir:
+            path = f"{dir}/seen.store"
+            build_seen_store(path, ["dumped00"])
+            server = Server(logger, "http://validator", "", 0, SeenStore(path))
+        game = chess.pgn.Game()
+        game.headers["Site"] = "https://lichess.org/marked00"
+        with unittest.mock.patch("server.seen_http.post", side_effect = ConnectionError("down")):
+            server.set_seen(game)
+            self.assertEqual(server.are_seen(["dumped00", "marked00", "unseen00"]), {"dumped00", "marked00"})
+
+    def test_refresh(self) -> None:
+        with tempfile.TemporaryDirectory() as dir:
+            path = f"{dir}/seen.store"
+            build_seen_store(path, ["game0000"])
+            store = SeenStore(path, refresh_every = 0)
+            store.add("recent00")
+            self.assertFalse("game0001" in store)
+            build_seen_store(path, ["game0000", "game0001"])
+            self.assertTrue("game0001" in store)
+            self.assertTrue("recent00" in store)
+
+
+def accepting(sent: List[dict]) -> Callable[[List[dict]], bool]:
+    def send(puzzles: List[dict]) -> bool:
+        sent.extend(puzzles)
+        return True
+    return send
+
+class TestSpool(unittest.TestCase):
+
+    def test_send_in_background(self) -> None:
+        sent: List[dict] = []
+        failures = [1]
+        def send(puzzles: List[dict]) -> bool:
+            if failures[0]:
+                failures[0] -= 1
+                return False
+            sent.extend(puzzles)
+            return True
+        with tempfile.TemporaryDirectory() as dir:
+            spool = Spool(logger, dir, send)
+            for i in range(120):
+                spool.append({"game_id": i})
+            spool.close()
+            self.assertEqual([p["game_id"] for p in sent], list(range(120)))
+            self.assertEqual(os.listdir(dir), [])
+
+    def test_resend_after_restart(self) -> None:
+        with tempfile.TemporaryDirectory() as dir:
+            spool = Spool(logger, dir, lambda puzzles: False)
+            for i in range(3):
+                spool.append({"game_id": i})
+            spool.close(timeout = 0.1)
+            sent: List[dict] = []
+            spool = Spool(logger, dir, accepting(sent))
+            spool.close()
+            self.assertEqual([p["game_id"] for p in sent], [0, 1, 2])
+
+    def test_live_spool_left_alone(self) -> None:
+        with tempfile.TemporaryDirectory() as dir:
+            other = os.path.join(dir, "1.jsonl")
+            with open(other, "w") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                f.write('{"seq": 1, "puzzle": {"game_id": 1}}\n')
+                f.flush()
+                sent: List[dict] = []
+                spool = Spool(logger, dir, accepting(sent))
+                spool.close()
+                self.assertEqual(sent, [])
+                self.assertTrue(os.path.exists(other))
+
+    def test_close_waits_for_breaker(self) -> None:
+        sent: List[dict] = []
+        failures = [1]
+        def send(puzzles: List[dict]) -> bool:
+            if failures[0]:
+                failures[0] -= 1
+                return False
+            sent.extend(puzzles)
+            return True
+        with tempfile.TemporaryDirectory() as dir:
+            spool = Spool(logger, dir, send)
+            spool.breaker = CircuitBreaker(threshold = 1, cooldown = 1.5)
+            spool.append({"game_id": 1})
+            spool.close(timeout = 5)
+            self.assertEqual(sent, [{"game_id": 1}])
+
+    def test_append_after_all_sent(self) -> None:
+        up = [True]
+        with tempfile.TemporaryDirectory() as dir:
+            spool = Spool(logger, dir, lambda puzzles: up[0])
+            spool.append({"game_id": 1})
+            while spool.unsent:
+                time.sleep(0.01)
+            up[0] = False
+            spool.append({"game_id": 2})
+            with open(spool.path) as f:
+                self.assertEqual(read_unsent(f), [{"game_id": 2}])
+            spool.close(timeout = 0.1)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,14 +1,18 @@
 from dataclasses import dataclass
 import math
+import threading
 import chess
 import chess.engine
 from model import EngineMove, NextMovePair
+from engines import Engine
 from chess import Color, Board
 from chess.pgn import GameNode
-from chess.engine import SimpleEngine, Score
-from typing import Optional
+from chess.engine import InfoDict, Score
+from typing import Callable, Iterable, List, Optional
 
 nps = []
+# searches run from several threads
+nps_lock = threading.Lock()
 
 def material_count(board: Board, side: Color) -> int:
     values = { chess.PAWN: 1, chess.KNIGHT: 3, chess.BISHOP: 3, chess.ROOK: 5, chess.QUEEN: 9 }
@@ -27,19 +31,40 @@ def maximum_castling_rights(board: chess.Board) -> chess.Bitboard:
     )
 
 
-def get_next_move_pair(engine: SimpleEngine, node: GameNode, winner: Color, limit: chess.engine.Limit) -> NextMovePair:
-    info = engine.analyse(node.board(), multipv = 2, limit = limit)
+def analyse_until(engine: Engine, board: Board, limit: chess.engine.Limit, multipv: int, stop: Callable[[List[InfoDict]], bool]) -> List[InfoDict]:
+    """Like `engine.analyse`, but the search stops early once `stop` is true of the lines at a given depth"""
+    with engine.analysis(board, limit, multipv = multipv) as analysis:
+        for info in analysis:
+            # lines are sent in order, the last one completes the depth
+            if info.get("multipv", 1) == multipv and "score" in info and stop(analysis.multipv):
+                analysis.stop()
+                break
+        return analysis.multipv
+
+def analyse_excluding(engine: Engine, board: Board, limit: chess.engine.Limit, excluded: Iterable[chess.Move]) -> Optional[InfoDict]:
+    """
+    Best line among the legal moves not in `excluded`, None if there are none.
+    A single line search restricted with `searchmoves`, much cheaper than a multipv search wide enough to get past them.
+    """
+    excluded = set(excluded)
+    root_moves = [move for move in board.legal_moves if move not in excluded]
+    return engine.analyse(board, limit, root_moves = root_moves) if root_moves else None
+
+def get_next_move_pair(engine: Engine, node: GameNode, winner: Color, limit: chess.engine.Limit, stop: Optional[Callable[[List[InfoDict]], bool]] = None, multipv: int = 2) -> NextMovePair:
+    info = analyse_until(engine, node.board(), limit, multipv, stop) if stop else engine.analyse(node.board(), multipv = multipv, limit = limit)
     global nps
-    nps.append(info[0]["nps"] / 1000)
-    nps = nps[-10000:]
+    if "nps" in info[0]:
+        with nps_lock:
+            nps.append(info[0]["nps"] / 1000)
+            nps = nps[-10000:]
     # print(info)
-    best = EngineMove(info[0]["pv"][0], info[0]["score"].pov(winner))
+    best = EngineMove(info[0]["pv"][0], info[0]["score"].pov(winner), info[0]["pv"])
     second = EngineMove(info[1]["pv"][0], info[1]["score"].pov(winner)) if len(info) > 1 else None
     return NextMovePair(node, winner, best, second)
 
 def avg_knps():
-    global nps
-    return round(sum(nps) / len(nps)) if nps else 0
+    with nps_lock:
+        return round(sum(nps) / len(nps)) if nps else 0
 
 def win_chances(score: Score) -> float:
     """
@@ -53,42 +78,40 @@ def win_chances(score: Score) -> float:
     MULTIPLIER = -0.00368208 # https://github.com/lichess-org/lila/pull/11148
     return 2 / (1 + math.exp(MULTIPLIER * cp)) - 1 if cp is not None else 0
 
-def time_control_tier(line: str) -> Optional[int]:
-    if not line.startswith("[TimeControl "):
-        return None
-    try:
-        seconds, increment = line[1:][:-2].split()[1].replace("\"", "").split("+")
-        total = int(seconds) + int(increment) * 40
-        if total >= 480:
-            return 3
-        if total >= 180:
-            return 2
-        if total > 60:
-            return 1
-        return 0
-    except:
-        return 0
+def time_control_tier(seconds: int, increment: int) -> int:
+    total = seconds + increment * 40
+    if total >= 480:
+        return 3
+    if total >= 180:
+        return 2
+    if total > 60:
+        return 1
+    return 0
     
 def count_mates(board:chess.Board) -> int:
-    mates = 0
+    return len(mates_in_one(board))
+
+def mates_in_one(board: chess.Board) -> List[chess.Move]:
+    mates = []
     for move in board.legal_moves:
         board.push(move)
         if board.is_checkmate():
-            mates += 1
+            mates.append(move)
         board.pop()
     return mates
 
-def rating_tier(line: str) -> Optional[int]:
-    if not line.startswith("[WhiteElo ") and not line.startswith("[BlackElo "):
-        return None
-    try:
-        rating = int(line[11:15])
-        if rating > 1750:
-            return 3
-        if rating > 1600:
-            return 2
-        if rating > 1500:
-            return 1
-        return 0
-    except:
-        return 0
+# the tier a game is analysed in: titled players and short games are worth searching harder
+def game_tier(tier: int, has_master: bool, nb_moves: int) -> int:
+    tier = tier + 1 if has_master else tier
+    tier = tier + 1 if nb_moves < 38 else tier
+    return tier + 1 if nb_moves < 21 else tier
+
+def rating_tier(rating: int) -> int:
+    if rating > 1750:
+        return 3
+    if rating > 1600:
+        return 2
+    if rating > 1500:
+        return 1
+    return 0
+
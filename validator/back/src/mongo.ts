@@ -45,5 +45,24 @@ export class SeenMongo {
   positionExists = (fen: string, move: string): Promise<boolean> =>
     this.puzzleColl.countDocuments({ fen: fen, 'moves.0': move }).then(n => n > 0);
 
+  existing = (ids: string[]): Promise<string[]> =>
+    ids.length
+      ? this.seenColl
+          .find({ _id: { $in: ids as any[] } }, { projection: { _id: 1 } })
+          .toArray()
+          .then(docs => docs.map(doc => doc._id as any as string))
+      : Promise.resolve([]);
+
+  existingPositions = (keys: string[]): Promise<string[]> =>
+    keys.length
+      ? this.puzzleColl
+          .find(
+            { $or: keys.map(key => ({ fen: key.split(':')[0], 'moves.0': key.split(':')[1] })) },
+            { projection: { fen: 1, moves: 1 } }
+          )
+          .toArray()
+          .then(docs => docs.map(doc => `${doc.fen}:${doc.moves[0]}`))
+      : Promise.resolve([]);
+
   set = (id: string) => this.seenColl.insertOne({ _id: id } as any).catch(() => { });
 }
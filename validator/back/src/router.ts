@@ -6,31 +6,41 @@ import { config } from './config';
 
 export default function (app: Express.Express, env: Env) {
   let duplicates = 0;
-  app.post('/puzzle', async (req, res) => {
-    if ((req.query.token as string) != config.generatorToken) return res.status(400).send('Wrong token');
+  const insert = async (body: any, ip: string): Promise<string> => {
     const puzzle: Puzzle = {
       _id: randomId(),
-      gameId: req.body.game_id,
-      fen: req.body.fen,
-      ply: req.body.ply,
-      moves: req.body.moves,
-      cp: req.body.cp,
-      generator: req.body.generator_version,
+      gameId: body.game_id,
+      fen: body.fen,
+      ply: body.ply,
+      moves: body.moves,
+      cp: body.cp,
+      generator: body.generator_version,
       createdAt: new Date(),
-      ip: req.ip,
+      ip,
     };
     try {
       await env.mongo.puzzle.insert(puzzle);
       console.log(puzzle.ip);
-      return res.send(`Created ${config.http.url}/puzzle/${puzzle._id}`);
+      return `Created ${config.http.url}/puzzle/${puzzle._id}`;
     } catch (e: any) {
       const msg = e.code == 11000 ? `Game ${puzzle.gameId} already in the puzzle DB!` : e.message;
       if (e.code == 11000) {
         duplicates++;
         console.info(`${duplicates} duplicates detected.`);
       } else console.warn(`Mongo insert error: ${msg}`);
-      return res.status(200).send(msg);
+      return msg;
     }
+  };
+  app.post('/puzzle', async (req, res) => {
+    if ((req.query.token as string) != config.generatorToken) return res.status(400).send('Wrong token');
+    return res.send(await insert(req.body, req.ip));
+  });
+  // body: { puzzles: [puzzle] }, responds with one message per puzzle
+  app.post('/puzzle/batch', async (req, res) => {
+    if ((req.query.token as string) != config.generatorToken) return res.status(400).send('Wrong token');
+    const messages: string[] = [];
+    for (const body of req.body.puzzles || []) messages.push(await insert(body, req.ip));
+    return res.send({ messages });
   });
 
   app.get('/seen', async (req, res) => {
@@ -45,6 +55,17 @@ export default function (app: Express.Express, env: Env) {
     process.stdout.write('.');
     return exists ? res.status(200).send() : res.status(404).send();
   });
+  // body: { ids: [gameId | "fen:uci"] }, responds with the subset already seen
+  app.post('/seen/batch', async (req, res) => {
+    if ((req.query.token as string) != config.generatorToken) return res.status(400).send('Wrong token');
+    const ids: string[] = req.body.ids || [];
+    const [games, positions] = await Promise.all([
+      env.mongo.seen.existing(ids.filter(id => id.length == 8)),
+      env.mongo.seen.existingPositions(ids.filter(id => id.length != 8)),
+    ]);
+    process.stdout.write('.');
+    return res.send({ seen: games.concat(positions) });
+  });
   app.post('/seen', async (req, res) => {
     if ((req.query.token as string) != config.generatorToken) return res.status(400).send('Wrong token');
     env.mongo.seen.set(req.query.id as string);